@@ -0,0 +1,200 @@
+# Daily usage rollups for the clinician dashboard.
+#
+# Message and PatientRequest rows are counted into DailyMessageRollup (per patient),
+# DailyMessageTotal (clinic-wide) and DailyRequestRollup (per patient). RollupWatermark remembers the highest id counted per source,
+# so each run only aggregates rows written since the last one; the dashboard reads
+# the rollup tables and never scans the raw tables. Bot replies are classified by
+# the canned strings in replies.py.
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import (
+    DailyMessageRollup, DailyMessageTotal, DailyRequestRollup, Message, PatientRequest,
+    RollupWatermark,
+)
+from .replies import BUSY_REPLY, LLM_ERROR_REPLY, LLM_REFUSAL_REPLY, OFF_TOPIC_REPLY
+
+MESSAGE_COUNTERS = {
+    'patient_messages': Q(sender='patient'),
+    'bot_messages': Q(sender='bot'),
+    'off_topic': Q(sender='bot', text=OFF_TOPIC_REPLY),
+    'busy_replies': Q(sender='bot', text=BUSY_REPLY),
+    'llm_errors': Q(sender='bot', text=LLM_ERROR_REPLY),
+    'llm_refusals': Q(sender='bot', text=LLM_REFUSAL_REPLY),
+}
+# Rows newer than this are left for the next run: an id below the watermark could
+# otherwise still be in an uncommitted transaction and never be counted
+SAFETY_LAG = timedelta(seconds=60)
+DEFAULT_BATCH_SIZE = 50000
+DEFAULT_DASHBOARD_DAYS = 30
+
+
+def _upsert(model, objects, unique_fields, update_fields):
+    if not objects:
+        return
+    options = {'update_conflicts': True, 'update_fields': update_fields}
+    # MySQL upserts on any unique key and rejects an explicit conflict target
+    if connection.features.supports_update_conflicts_with_target:
+        options['unique_fields'] = unique_fields
+    model.objects.bulk_create(objects, batch_size=1000, **options)
+
+
+def _increment(model, key_fields, unique_fields, counters, groups):
+    # Adds each group's counters to its rollup row, creating the rows that don't exist yet
+    filters = {f'{field}__in': {group[field] for group in groups} for field in key_fields}
+    existing = {
+        tuple(getattr(rollup, field) for field in key_fields): rollup
+        for rollup in model.objects.filter(**filters)
+    }
+    rollups = []
+    for group in groups:
+        key = tuple(group[field] for field in key_fields)
+        rollup = existing.get(key) or model(**dict(zip(key_fields, key)))
+        for name in counters:
+            setattr(rollup, name, getattr(rollup, name) + group[name])
+        rollups.append(rollup)
+    _upsert(model, rollups, unique_fields, list(counters))
+
+
+def _roll_messages(low, high):
+    groups = list(
+        Message.objects.filter(id__gt=low, id__lte=high, patient__isnull=False)
+        .annotate(day=TruncDate('timestamp'))
+        .values('day', 'patient_id')
+        .annotate(rows=Count('id'), **{
+            name: Count('id', filter=condition) for name, condition in MESSAGE_COUNTERS.items()
+        })
+    )
+    if not groups:
+        return 0
+    _increment(DailyMessageRollup, ('day', 'patient_id'), ['day', 'patient'], MESSAGE_COUNTERS, groups)
+
+    totals = {}
+    for group in groups:
+        day_total = totals.setdefault(group['day'], {'day': group['day'], **dict.fromkeys(MESSAGE_COUNTERS, 0)})
+        for name in MESSAGE_COUNTERS:
+            day_total[name] += group[name]
+    _increment(DailyMessageTotal, ('day',), ['day'], MESSAGE_COUNTERS, list(totals.values()))
+    return sum(group['rows'] for group in groups)
+
+
+def _roll_requests(low, high):
+    groups = list(
+        PatientRequest.objects.filter(id__gt=low, id__lte=high)
+        .annotate(day=TruncDate('timestamp'))
+        .values('day', 'patient_id', 'request_type')
+        .annotate(count=Count('id'))
+    )
+    if not groups:
+        return 0
+    _increment(
+        DailyRequestRollup, ('day', 'patient_id', 'request_type'), ['day', 'patient', 'request_type'], ['count'],
+        groups,
+    )
+    return sum(group['count'] for group in groups)
+
+
+SOURCES = {
+    'messages': (Message, _roll_messages),
+    'requests': (PatientRequest, _roll_requests),
+}
+
+
+def _advance(source, batch_size, cutoff):
+    # Counts the next batch_size rows past the watermark (None once caught up). Rollups
+    # and watermark commit together; the locked watermark row keeps concurrent runs apart.
+    model, roll = SOURCES[source]
+    with transaction.atomic():
+        watermark, _created = RollupWatermark.objects.select_for_update().get_or_create(source=source)
+        pending = model.objects.filter(id__gt=watermark.last_id, timestamp__lt=cutoff).order_by('id')
+        high = pending.values_list('id', flat=True)[batch_size - 1:batch_size].first()
+        if high is None:
+            high = pending.values_list('id', flat=True).last()
+        if high is None:
+            return None
+        rows = roll(watermark.last_id, high)
+        watermark.last_id = high
+        watermark.save(update_fields=['last_id', 'updated_at'])
+    return rows
+
+
+def update_rollups(batch_size=DEFAULT_BATCH_SIZE, now=None):
+    cutoff = (now or timezone.now()) - SAFETY_LAG
+    counted = {}
+    for source in SOURCES:
+        counted[source] = 0
+        while True:
+            rows = _advance(source, batch_size, cutoff)
+            if rows is None:
+                break
+            counted[source] += rows
+    return counted
+
+
+def reset_rollups():
+    # For when the classification changes: the next update_rollups recounts everything
+    with transaction.atomic():
+        DailyMessageRollup.objects.all().delete()
+        DailyMessageTotal.objects.all().delete()
+        DailyRequestRollup.objects.all().delete()
+        RollupWatermark.objects.all().delete()
+
+
+def _rate(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+
+def _with_rates(counts):
+    # LLM calls: bot replies that were not an off-topic rejection or a busy reply
+    llm_calls = counts['bot_messages'] - counts['off_topic'] - counts['busy_replies']
+    return {
+        **counts,
+        'off_topic_rate': _rate(counts['off_topic'], counts['patient_messages']),
+        'llm_failure_rate': _rate(counts['llm_errors'], llm_calls),
+        'llm_refusal_rate': _rate(counts['llm_refusals'], llm_calls),
+    }
+
+
+def dashboard(start=None, end=None, patient_id=None):
+    # Every query reads only rollup rows: one per day for messages, and one per day, request
+    # type and patient for requests (summed over patients for the clinic-wide view)
+    end = end or timezone.localdate()
+    start = start or end - timedelta(days=DEFAULT_DASHBOARD_DAYS - 1)
+
+    if patient_id is None:
+        messages = DailyMessageTotal.objects.all()
+    else:
+        messages = DailyMessageRollup.objects.filter(patient_id=patient_id)
+    days = [
+        _with_rates({'date': row.pop('day').isoformat(), **row})
+        for row in messages.filter(day__gte=start, day__lte=end).order_by('day').values('day', *MESSAGE_COUNTERS)
+    ]
+    totals = {name: sum(day[name] for day in days) for name in MESSAGE_COUNTERS}
+
+    requests = DailyRequestRollup.objects.filter(day__gte=start, day__lte=end)
+    if patient_id is not None:
+        requests = requests.filter(patient_id=patient_id)
+    request_days = [
+        {'date': day.isoformat(), 'request_type': request_type, 'count': count}
+        for day, request_type, count in requests.values('day', 'request_type').annotate(
+            total=Sum('count')).order_by('day', 'request_type').values_list('day', 'request_type', 'total')
+    ]
+    request_totals = {}
+    for row in request_days:
+        request_totals[row['request_type']] = request_totals.get(row['request_type'], 0) + row['count']
+
+    return {
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'patient_id': patient_id,
+        'totals': _with_rates(totals),
+        'days': days,
+        'requests': {'totals': request_totals, 'days': request_days},
+        'rolled_up_to': {
+            watermark.source: watermark.updated_at.isoformat() for watermark in RollupWatermark.objects.all()
+        },
+    }
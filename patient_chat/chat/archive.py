@@ -0,0 +1,202 @@
+# Cold storage for old chat messages.
+#
+# Old rows are moved out of the hot Message table into MessageArchiveSegment rows,
+# one run of messages per segment. A segment's payload is a sequence of small,
+# independently compressed blocks (zstd when the `zstandard` package is installed,
+# gzip otherwise). The block index lets history be read back one block at a time,
+# newest first, without decompressing the whole segment.
+import gzip
+import json
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .models import Message, MessageArchiveSegment
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_SEGMENT_SIZE = 2000
+DEFAULT_BLOCK_SIZE = 64
+
+
+def default_codec():
+    return 'zstd' if zstandard is not None else 'gzip'
+
+
+def compress(raw, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    return gzip.compress(raw, compresslevel=6)
+
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("This archive segment needs the `zstandard` package to be read.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def encode_block(messages):
+    lines = [
+        json.dumps([m.id, m.sender, m.text, m.timestamp.isoformat()], ensure_ascii=False)
+        for m in messages
+    ]
+    return '\n'.join(lines).encode('utf-8')
+
+
+def decode_block(raw):
+    messages = []
+    for line in raw.decode('utf-8').split('\n'):
+        message_id, sender, text, timestamp = json.loads(line)
+        messages.append({
+            'id': message_id,
+            'sender': sender,
+            'text': text,
+            'timestamp': parse_datetime(timestamp),
+        })
+    return messages
+
+
+def before_cursor(before, before_id=None):
+    # Messages strictly older than the (timestamp, id) cursor; messages sharing the cursor's
+    # timestamp are told apart by id. Without an id the cursor is the timestamp alone.
+    if before_id is None:
+        return Q(timestamp__lt=before)
+    return Q(timestamp__lt=before) | Q(timestamp=before, id__lt=before_id)
+
+
+def is_before(message, before, before_id=None):
+    # before_cursor() for a decoded archived message
+    if before_id is None:
+        return message['timestamp'] < before
+    return (message['timestamp'], message['id']) < (before, before_id)
+
+
+def build_segment(patient, messages, block_size=DEFAULT_BLOCK_SIZE, codec=None):
+    codec = codec or default_codec()
+    chunks = []
+    block_index = []
+    offset = 0
+    raw_size = 0
+    for start in range(0, len(messages), block_size):
+        block = messages[start:start + block_size]
+        raw = encode_block(block)
+        data = compress(raw, codec)
+        block_index.append([
+            offset, len(data), len(block),
+            block[0].timestamp.isoformat(), block[-1].timestamp.isoformat(),
+        ])
+        chunks.append(data)
+        offset += len(data)
+        raw_size += len(raw)
+
+    return MessageArchiveSegment(
+        patient=patient,
+        # Messages are in (timestamp, id) order, so ids need not be: store the id range
+        first_message_id=min(m.id for m in messages),
+        last_message_id=max(m.id for m in messages),
+        start_time=messages[0].timestamp,
+        end_time=messages[-1].timestamp,
+        message_count=len(messages),
+        codec=codec,
+        raw_size=raw_size,
+        data=b''.join(chunks),
+        block_index=block_index,
+    )
+
+
+def archive_patient_messages(patient, keep_recent=200, older_than=None, max_id=None,
+                             segment_size=DEFAULT_SEGMENT_SIZE, block_size=DEFAULT_BLOCK_SIZE,
+                             codec=None):
+    # Move everything but the newest `keep_recent` messages (and, if given, only those
+    # older than `older_than` and with ids up to `max_id`) into archive segments.
+    # Returns the segments written.
+    hot = Message.objects.filter(patient=patient).order_by('-timestamp', '-id')
+    boundary = hot.values_list('timestamp', 'id')[keep_recent:keep_recent + 1].first()
+    if boundary is None:
+        return []
+
+    # The boundary message and everything before it in (timestamp, id) order, the same
+    # order that picked the boundary, so no message among the newest keep_recent is taken
+    boundary_time, boundary_id = boundary
+    candidates = Message.objects.filter(
+        Q(timestamp__lt=boundary_time) | Q(timestamp=boundary_time, id__lte=boundary_id), patient=patient,
+    ).order_by('timestamp', 'id')
+    if older_than is not None:
+        candidates = candidates.filter(timestamp__lt=older_than)
+    if max_id is not None:
+        candidates = candidates.filter(id__lte=max_id)
+
+    segments = []
+    while True:
+        batch = list(candidates[:segment_size])
+        if not batch:
+            break
+        with transaction.atomic():
+            segment = build_segment(patient, batch, block_size=block_size, codec=codec)
+            segment.save()
+            Message.objects.filter(id__in=[m.id for m in batch]).delete()
+        segments.append(segment)
+        if len(batch) < segment_size:
+            break
+    return segments
+
+
+def iter_segment_blocks_reversed(segment):
+    data = bytes(segment.data)
+    for offset, length, _count, _first, _last in reversed(segment.block_index):
+        yield decode_block(decompress(data[offset:offset + length], segment.codec))
+
+
+def iter_archived_messages(patient, before=None, before_id=None):
+    # Yield archived messages newest first, decompressing one block at a time; with a
+    # cursor, only those before (before, before_id) in (timestamp, id) order
+    segments = MessageArchiveSegment.objects.filter(patient=patient).order_by('-end_time', '-id')
+    if before is not None:
+        segments = segments.filter(start_time__lte=before)
+
+    for segment in segments.iterator():
+        for block in iter_segment_blocks_reversed(segment):
+            for message in reversed(block):
+                if before is None or is_before(message, before, before_id):
+                    yield message
+
+
+def load_history_page(patient, before=None, before_id=None, limit=50):
+    # Messages before the (before, before_id) cursor, newest first: the hot table is read
+    # first, then the archive. Pass the last message's timestamp and id as the next cursor.
+    hot = Message.objects.filter(patient=patient).order_by('-timestamp', '-id')
+    if before is not None:
+        hot = hot.filter(before_cursor(before, before_id))
+    page = [
+        {'id': m.id, 'sender': m.sender, 'text': m.text, 'timestamp': m.timestamp}
+        for m in hot[:limit]
+    ]
+
+    if len(page) < limit:
+        if page:
+            before, before_id = page[-1]['timestamp'], page[-1]['id']
+        for message in iter_archived_messages(patient, before=before, before_id=before_id):
+            page.append(message)
+            if len(page) >= limit:
+                break
+    return page
+
+
+def find_archived_message(patient_id, message_id):
+    # Id ranges of segments (and of blocks inside them) can overlap, since segments are cut
+    # in (timestamp, id) order: check every message of every segment whose range covers the id
+    segments = MessageArchiveSegment.objects.filter(
+        patient_id=patient_id, first_message_id__lte=message_id, last_message_id__gte=message_id
+    ).order_by('-id')
+    for segment in segments.iterator():
+        for block in iter_segment_blocks_reversed(segment):
+            for message in block:
+                if message['id'] == message_id:
+                    return message
+    return None
@@ -0,0 +1,79 @@
+# Entity extraction from patient messages.
+#
+# Kept out of views so batch jobs can import it without the chat app's settings:
+# LLM_API_KEY is only read when a real chat model has to be built, so an offline
+# stub passed as `llm` needs no key at all.
+import os
+import re
+
+from dotenv import load_dotenv
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+from langchain.prompts import PromptTemplate
+from langchain.schema import HumanMessage
+
+from .rate_limit import BACKGROUND
+from .resilience import call_with_resilience, get_config as resilience_config
+
+load_dotenv(override=True)
+
+LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "gemini-1.5-flash")
+
+RESPONSE_SCHEMAS = [
+    ResponseSchema(name="medication", description="Name of the medication mentioned by the patient"),
+    ResponseSchema(name="frequency", description="Frequency of medication intake"),
+    ResponseSchema(name="date", description="Date mentioned in the message"),
+    ResponseSchema(name="time", description="Time mentioned in the message"),
+    ResponseSchema(name="symptom", description="Symptom mentioned by the patient"),
+    ResponseSchema(name="diet", description="Diet mentioned by the patient"),
+    ResponseSchema(name="lab_test", description="Lab test mentioned by the patient"),
+    ResponseSchema(name="vital_sign", description="Vital sign mentioned by the patient"),
+]
+OUTPUT_PARSER = StructuredOutputParser.from_response_schemas(RESPONSE_SCHEMAS)
+PROMPT = PromptTemplate(
+    template=(
+        "You are an assistant that extracts relevant health-related information from patient messages. "
+        "Only extract information related to medications, symptoms, dates, times, and present it in the specified JSON format.\n"
+        "{format_instructions}\n\nMessage: {message}\n"
+    ),
+    input_variables=["message"],
+    partial_variables={"format_instructions": OUTPUT_PARSER.get_format_instructions()}
+)
+
+
+def preprocess_message(message):
+    # Replace ordinal numbers with cardinal numbers (e.g., '1st' -> '1')
+    return re.sub(r'\b(\d+)(st|nd|rd|th)\b', r'\1', message)
+
+
+def extraction_llm():
+    api_key = os.getenv("LLM_API_KEY")
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY environment variable not set.")
+    return ChatGoogleGenerativeAI(
+        model=LLM_MODEL_NAME,
+        temperature=0,
+        google_api_key=api_key,
+        max_retries=0,
+        timeout=resilience_config()['CALL_TIMEOUT_SECONDS'],
+    )
+
+
+def extract_entities(message, llm=None, admission=BACKGROUND):
+    # Raises on failure, including RateLimited when no LLM slot frees up in time;
+    # callers can pass their own chat model (e.g. an offline stub for backfills)
+    if llm is None:
+        llm = extraction_llm()
+    _input = PROMPT.format_prompt(message=message)
+    response = call_with_resilience(
+        'gemini_extraction', lambda: llm([HumanMessage(content=_input.to_string())]), admission=admission
+    )
+    return OUTPUT_PARSER.parse(response.content)
+
+
+def extract_entities_with_llm(message, llm=None, admission=BACKGROUND):
+    try:
+        return extract_entities(message, llm=llm, admission=admission)
+    except Exception:
+        # Under load (RateLimited) or on a bad response no entities are returned
+        return {}
@@ -0,0 +1,91 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chat.analytics import update_rollups
+from chat.archive import (
+    DEFAULT_BLOCK_SIZE, DEFAULT_SEGMENT_SIZE, archive_patient_messages, default_codec,
+    iter_archived_messages,
+)
+from chat.models import Patient, RollupWatermark
+
+
+class Command(BaseCommand):
+    help = "Compact old chat messages into compressed per-patient archive segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patient-id', type=int, help="Only compact this patient's conversation.")
+        parser.add_argument('--keep', type=int, default=200,
+                            help="Number of newest messages to leave in the hot table (default 200).")
+        parser.add_argument('--older-than-days', type=int,
+                            help="Only archive messages older than this many days.")
+        parser.add_argument('--segment-size', type=int, default=DEFAULT_SEGMENT_SIZE,
+                            help="Messages per archive segment.")
+        parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE,
+                            help="Messages per compressed block inside a segment.")
+        parser.add_argument('--codec', choices=['zstd', 'gzip'], default=default_codec())
+        parser.add_argument('--verify', action='store_true',
+                            help="Read the archive back afterwards and report read throughput.")
+
+    def handle(self, *args, **options):
+        if options['codec'] == 'zstd' and default_codec() != 'zstd':
+            raise CommandError("The zstd codec needs the `zstandard` package installed.")
+
+        patients = Patient.objects.all()
+        if options['patient_id']:
+            patients = patients.filter(pk=options['patient_id'])
+
+        older_than = None
+        if options['older_than_days'] is not None:
+            older_than = timezone.now() - timedelta(days=options['older_than_days'])
+
+        # Archived rows leave the Message table, so only messages already counted into the
+        # analytics rollups may go: roll up first, then stop at the watermark
+        update_rollups()
+        rolled_up_to = RollupWatermark.objects.filter(source='messages').values_list('last_id', flat=True).first()
+
+        total_messages = 0
+        total_raw = 0
+        total_compressed = 0
+        started = time.perf_counter()
+        for patient in patients.iterator():
+            segments = archive_patient_messages(
+                patient,
+                keep_recent=options['keep'],
+                older_than=older_than,
+                max_id=rolled_up_to or 0,
+                segment_size=options['segment_size'],
+                block_size=options['block_size'],
+                codec=options['codec'],
+            )
+            for segment in segments:
+                total_messages += segment.message_count
+                total_raw += segment.raw_size
+                total_compressed += len(segment.data)
+            if segments:
+                self.stdout.write(f"{patient}: archived {sum(s.message_count for s in segments)} messages "
+                                  f"into {len(segments)} segments")
+        elapsed = time.perf_counter() - started
+
+        if not total_messages:
+            self.stdout.write("Nothing to archive.")
+            return
+
+        ratio = total_raw / total_compressed if total_compressed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {total_messages} messages in {elapsed:.2f}s "
+            f"({total_messages / elapsed:.0f} msg/s, {total_raw / elapsed / 1e6:.1f} MB/s raw), "
+            f"{total_raw} -> {total_compressed} bytes ({ratio:.1f}x, {options['codec']})"
+        ))
+
+        if options['verify']:
+            read = 0
+            started = time.perf_counter()
+            for patient in patients.iterator():
+                for _message in iter_archived_messages(patient):
+                    read += 1
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"Read back {read} archived messages in {elapsed:.2f}s "
+                              f"({read / elapsed:.0f} msg/s)")
@@ -0,0 +1,107 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from chat.measurements import refresh_summaries
+from chat.models import Measurement, Patient
+
+
+class Command(BaseCommand):
+    help = (
+        "Append measurements (patient_id, kind, value, unit, timestamp) from a CSV or JSONL "
+        "file, then refresh the rolling summaries of every patient touched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help="CSV (with a header row) or JSONL file.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'])
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--summary-batch', type=int, default=500,
+                            help="Patients whose summaries are recomputed together.")
+        parser.add_argument('--refresh-only', action='store_true',
+                            help="Skip ingest and recompute summaries for every patient with measurements.")
+
+    def handle(self, *args, **options):
+        if options['refresh_only']:
+            patient_ids = set(Measurement.objects.values_list('patient_id', flat=True).distinct())
+        else:
+            if not options['path']:
+                raise CommandError("A path is required unless --refresh-only is given.")
+            patient_ids = self.ingest(options)
+        self.refresh(sorted(patient_ids), options['summary_batch'])
+
+    def ingest(self, options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist.")
+        input_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        known_patients = set(Patient.objects.values_list('id', flat=True))
+
+        patient_ids = set()
+        ingested = 0
+        rejected = 0
+        started = time.perf_counter()
+        with open(path, newline='', encoding='utf-8') as handle:
+            rows = csv.DictReader(handle) if input_format == 'csv' else self.read_jsonl(handle)
+            while True:
+                chunk = list(islice(rows, options['chunk_size']))
+                if not chunk:
+                    break
+                measurements = []
+                for row in chunk:
+                    measurement = self.build(row, known_patients)
+                    if measurement is None:
+                        rejected += 1
+                        continue
+                    measurements.append(measurement)
+                    patient_ids.add(measurement.patient_id)
+                Measurement.objects.bulk_create(measurements, batch_size=1000)
+                ingested += len(measurements)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"Ingested {ingested} measurements ({rejected} rejected) in {elapsed:.2f}s "
+            f"({ingested / elapsed if elapsed else 0:.0f} rows/s)"
+        )
+        return patient_ids
+
+    def read_jsonl(self, handle):
+        for line in handle:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # build() rejects the None, so a malformed line is counted instead of aborting the import
+                yield None
+
+    def build(self, row, known_patients):
+        try:
+            patient_id = int(row['patient_id'])
+            value = float(row['value'])
+            timestamp = parse_datetime(str(row['timestamp']))
+        except (KeyError, TypeError, ValueError):
+            return None
+        if patient_id not in known_patients or timestamp is None or not row.get('kind'):
+            return None
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        return Measurement(
+            patient_id=patient_id, kind=str(row['kind']).strip().lower()[:50], value=value,
+            unit=str(row.get('unit') or '')[:20], timestamp=timestamp,
+        )
+
+    def refresh(self, patient_ids, batch_size):
+        started = time.perf_counter()
+        summaries = 0
+        for start in range(0, len(patient_ids), batch_size):
+            summaries += refresh_summaries(patient_ids[start:start + batch_size])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Refreshed {summaries} summaries for {len(patient_ids)} patients in {elapsed:.2f}s"
+        ))
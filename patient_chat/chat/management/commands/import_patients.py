@@ -0,0 +1,206 @@
+import csv
+import json
+import os
+import time
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from chat.measurements import record_patient_weights
+from chat.models import Patient
+from chat.neo4j_driver import get_graph_driver
+
+UNIQUE_FIELDS = ['first_name', 'last_name', 'date_of_birth']
+UPDATE_FIELDS = [
+    'phone_number', 'email', 'medical_condition', 'medication_regimen', 'last_appointment',
+    'next_appointment', 'doctor_name', 'lab_tests', 'vital_signs', 'weight',
+]
+DATE_FIELDS = ['date_of_birth']
+DATETIME_FIELDS = ['last_appointment', 'next_appointment']
+
+
+class MalformedRow:
+    # Stands in for a JSONL line that is not a JSON object, so validate() rejects it
+    # in place and the row count (and checkpoint) stays aligned with the file
+    def __init__(self, line, error):
+        self.line = line
+        self.error = error
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk import patients from a CSV or JSONL roster. Rows are upserted on "
+        "(first_name, last_name, date_of_birth) in chunks, synced to the knowledge graph, "
+        "and progress is checkpointed so an interrupted import can resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV (with a header row) or JSONL file.")
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help="Input format (default: from the file extension).")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--checkpoint', help="Checkpoint file (default: <path>.checkpoint).")
+        parser.add_argument('--restart', action='store_true', help="Ignore an existing checkpoint.")
+        parser.add_argument('--skip-graph', action='store_true', help="Do not sync patients to Neo4j.")
+        parser.add_argument('--errors', help="Write rejected rows with their errors to this JSONL file.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist.")
+        input_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        checkpoint_path = options['checkpoint'] or f"{path}.checkpoint"
+
+        start_row = 0 if options['restart'] else self.read_checkpoint(checkpoint_path, path)
+        if start_row:
+            self.stdout.write(f"Resuming after row {start_row} from {checkpoint_path}")
+
+        graph = None if options['skip_graph'] else get_graph_driver()
+        errors_file = open(options['errors'], 'a') if options['errors'] else None
+
+        rows_done = start_row
+        imported = 0
+        rejected = 0
+        started = time.perf_counter()
+        try:
+            with open(path, newline='', encoding='utf-8') as handle:
+                rows = islice(self.read_rows(handle, input_format), start_row, None)
+                while True:
+                    chunk = list(islice(rows, options['chunk_size']))
+                    if not chunk:
+                        break
+                    chunk_started = time.perf_counter()
+                    patients, chunk_errors = self.validate(chunk, rows_done)
+                    for error in chunk_errors:
+                        rejected += 1
+                        if errors_file:
+                            errors_file.write(json.dumps(error, default=str) + '\n')
+
+                    self.upsert(patients)
+                    if graph is not None:
+                        graph.save_patients_batch(patients)
+
+                    rows_done += len(chunk)
+                    imported += len(patients)
+                    self.write_checkpoint(checkpoint_path, path, rows_done)
+                    chunk_elapsed = time.perf_counter() - chunk_started
+                    self.stdout.write(
+                        f"Rows {rows_done - len(chunk) + 1}-{rows_done}: {len(patients)} imported, "
+                        f"{len(chunk_errors)} rejected ({len(chunk) / chunk_elapsed:.0f} rows/s)"
+                    )
+        finally:
+            if errors_file:
+                errors_file.close()
+
+        elapsed = time.perf_counter() - started
+        processed = rows_done - start_row
+        rate = processed / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {imported} patients, rejected {rejected}, "
+            f"{processed} rows in {elapsed:.1f}s ({rate:.0f} rows/s)"
+        ))
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    def read_rows(self, handle, input_format):
+        if input_format == 'csv':
+            yield from csv.DictReader(handle)
+            return
+        for line in handle:
+            line = line.strip()
+            # Blank lines still count as rows so checkpoints stay aligned with the file
+            if not line:
+                yield {}
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as error:
+                yield MalformedRow(line, f"Invalid JSON: {error}")
+                continue
+            yield row if isinstance(row, dict) else MalformedRow(line, "Expected a JSON object")
+
+    def read_checkpoint(self, checkpoint_path, path):
+        if not os.path.exists(checkpoint_path):
+            return 0
+        with open(checkpoint_path) as handle:
+            checkpoint = json.load(handle)
+        if checkpoint.get('input') != os.path.abspath(path):
+            raise CommandError(f"{checkpoint_path} belongs to another input; use --restart or --checkpoint.")
+        return checkpoint['rows_done']
+
+    def write_checkpoint(self, checkpoint_path, path, rows_done):
+        temporary = f"{checkpoint_path}.tmp"
+        with open(temporary, 'w') as handle:
+            json.dump({'input': os.path.abspath(path), 'rows_done': rows_done}, handle)
+        os.replace(temporary, checkpoint_path)
+
+    def validate(self, chunk, offset):
+        patients = {}
+        errors = []
+        for number, row in enumerate(chunk, start=offset + 1):
+            if isinstance(row, MalformedRow):
+                errors.append({'row': number, 'data': row.line, 'errors': row.error})
+                continue
+            try:
+                patient = self.build_patient(row)
+                patient.full_clean(validate_unique=False)
+            except (ValidationError, ValueError, TypeError) as error:
+                messages = error.message_dict if hasattr(error, 'message_dict') else str(error)
+                errors.append({'row': number, 'data': row, 'errors': messages})
+                continue
+            # The last occurrence of a patient within a chunk wins
+            patients[(patient.first_name, patient.last_name, patient.date_of_birth)] = patient
+        return list(patients.values()), errors
+
+    def build_patient(self, row):
+        values = {}
+        for field in UNIQUE_FIELDS + UPDATE_FIELDS:
+            value = row.get(field)
+            if isinstance(value, str):
+                value = value.strip()
+            values[field] = None if value in ('', None) else value
+
+        for field in DATE_FIELDS:
+            if values[field] is not None:
+                parsed = parse_date(str(values[field]))
+                if parsed is None:
+                    raise ValidationError({field: [f"Invalid date: {values[field]!r}"]})
+                values[field] = parsed
+        for field in DATETIME_FIELDS:
+            if values[field] is not None:
+                parsed = parse_datetime(str(values[field]))
+                if parsed is None:
+                    raise ValidationError({field: [f"Invalid datetime: {values[field]!r}"]})
+                if timezone.is_naive(parsed):
+                    parsed = timezone.make_aware(parsed)
+                values[field] = parsed
+        if values['weight'] is not None:
+            values['weight'] = float(values['weight'])
+        return Patient(**values)
+
+    def upsert(self, patients):
+        if not patients:
+            return
+        options = {'update_conflicts': True, 'update_fields': UPDATE_FIELDS}
+        # MySQL upserts on any unique key and rejects an explicit conflict target
+        if connection.features.supports_update_conflicts_with_target:
+            options['unique_fields'] = UNIQUE_FIELDS
+        with transaction.atomic():
+            Patient.objects.bulk_create(patients, **options)
+            # bulk_create skips post_save, so weights are recorded here; backends that don't
+            # return ids from an upsert (MySQL) need a lookup first
+            if any(patient.pk is None for patient in patients):
+                ids = {
+                    (first_name, last_name, date_of_birth): patient_id
+                    for first_name, last_name, date_of_birth, patient_id in Patient.objects.filter(
+                        first_name__in={patient.first_name for patient in patients},
+                        last_name__in={patient.last_name for patient in patients},
+                    ).values_list(*UNIQUE_FIELDS, 'id')
+                }
+                for patient in patients:
+                    patient.pk = ids.get((patient.first_name, patient.last_name, patient.date_of_birth))
+            record_patient_weights(patients)
@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from chat.archive import iter_archived_messages
+from chat.models import MemoryItem, Message, Patient
+from chat.neo4j_driver import get_graph_driver, get_patient_properties
+from chat.retrieval import (
+    count_tokens, forget_patient, get_index, message_memory_text, remember_entities, remember_facts, remember_many,
+    retrieve,
+)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-patient retrieval index from message history, patient facts and graph entities."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patient-id', type=int)
+        parser.add_argument('--skip-rebuild', action='store_true', help="Only run the benchmark.")
+        parser.add_argument('--skip-graph', action='store_true',
+                            help="Do not read extracted entities back from Neo4j.")
+        parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                            help="Compare prompt context for the last N patient messages: "
+                                 "last-5 messages plus every fact versus retrieval.")
+
+    def handle(self, *args, **options):
+        patients = Patient.objects.all()
+        if options['patient_id']:
+            patients = patients.filter(pk=options['patient_id'])
+        graph = None if options['skip_graph'] or options['skip_rebuild'] else get_graph_driver()
+
+        for patient in patients.iterator():
+            if not options['skip_rebuild']:
+                self.rebuild(patient, graph)
+            if options['benchmark']:
+                self.benchmark(patient, options['benchmark'])
+
+    def rebuild(self, patient, graph):
+        started = time.perf_counter()
+        forget_patient(patient.pk)
+        remember_facts(patient.pk, get_patient_properties(patient))
+        if graph is not None:
+            # Entities extracted from messages are only kept in the graph
+            remember_entities(patient.pk, graph.get_patient_entities(f"{patient.first_name} {patient.last_name}"))
+        count = 0
+
+        def message_rows():
+            nonlocal count
+            for message in iter_archived_messages(patient):
+                count += 1
+                yield (
+                    'message', message['id'], message_memory_text(message['sender'], message['text']),
+                    message['timestamp'], message['text'],
+                )
+            for message in Message.objects.filter(patient=patient).iterator():
+                count += 1
+                yield (
+                    'message', message.id, message_memory_text(message.sender, message.text),
+                    message.timestamp, message.text,
+                )
+
+        remember_many(patient.pk, message_rows())
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"{patient}: indexed {count} messages in {elapsed:.2f}s ({count / elapsed:.0f} msg/s)")
+
+    def benchmark(self, patient, sample_size):
+        started = time.perf_counter()
+        index = get_index(patient.pk)
+        load_ms = (time.perf_counter() - started) * 1000
+        facts = list(MemoryItem.objects.filter(patient=patient, source='fact').values_list('text', flat=True))
+        samples = list(
+            Message.objects.filter(patient=patient, sender='patient').order_by('-timestamp')[:sample_size]
+        )
+
+        baseline_tokens = []
+        retrieval_tokens = []
+        latencies = []
+        for message in samples:
+            previous = Message.objects.filter(patient=patient, timestamp__lte=message.timestamp).order_by('-timestamp')[:5]
+            baseline_tokens.append(sum(count_tokens(m.text) for m in previous) + sum(count_tokens(f) for f in facts))
+
+            started = time.perf_counter()
+            items = retrieve(patient.pk, message.text, 400, exclude_message_ids=[message.id])
+            latencies.append((time.perf_counter() - started) * 1000)
+            retrieval_tokens.append(sum(item['token_count'] for item in items))
+
+        if not samples:
+            self.stdout.write(f"{patient}: no patient messages to benchmark")
+            return
+        latencies = np.array(latencies)
+        self.stdout.write(
+            f"{patient}: {len(index.items)} items, index load {load_ms:.1f}ms, "
+            f"retrieval p50 {np.percentile(latencies, 50):.2f}ms p95 {np.percentile(latencies, 95):.2f}ms, "
+            f"context tokens baseline {np.mean(baseline_tokens):.0f} vs retrieval {np.mean(retrieval_tokens):.0f}"
+        )
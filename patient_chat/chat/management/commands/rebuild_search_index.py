@@ -0,0 +1,135 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from chat.archive import iter_segment_blocks_reversed
+from chat.models import Message, MessageArchiveSegment, Patient, PatientRequest, SearchDocument, SearchPosting
+from chat.search import STATS_CACHE_KEY, index_documents, search
+
+# Vocabulary of the synthetic --benchmark documents, most frequent first
+SYNTHETIC_TERMS = [
+    'pain', 'today', 'feel', 'better', 'worse', 'night', 'headache', 'medication', 'dose', 'dosage',
+    'morning', 'tired', 'doctor', 'appointment', 'blood', 'pressure', 'sleep', 'cough', 'fever', 'nausea',
+    'knee', 'back', 'chest', 'dizzy', 'insulin', 'metformin', 'lisinopril', 'rash', 'swelling', 'allergy',
+]
+BENCHMARK_QUERIES = ['dosage', 'headache worse at night', 'metformin nausea']
+BENCHMARK_RUNS = 5
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index from messages, archived messages and patient requests."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--query', action='append', default=[],
+                            help="Run this query after rebuilding and report its latency (repeatable).")
+        parser.add_argument('--patient-id', type=int, help="Patient filter for --query.")
+        parser.add_argument('--from', dest='start', help="Start of the date range for --query (ISO 8601).")
+        parser.add_argument('--to', dest='end', help="End of the date range for --query (ISO 8601).")
+        parser.add_argument('--skip-rebuild', action='store_true', help="Only run the --query benchmarks.")
+        parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                            help="Time the --query searches (or a default set) with N synthetic documents "
+                                 "added to the index. Everything is rolled back afterwards.")
+
+    def handle(self, *args, **options):
+        if options['benchmark']:
+            self.benchmark(options['benchmark'], options)
+            return
+        if not options['skip_rebuild']:
+            self.rebuild(options['batch_size'])
+        for query in options['query']:
+            self.run_query(query, options)
+
+    def rebuild(self, batch_size):
+        started = time.perf_counter()
+        # Postings first: they have no dependents, so this is a single fast DELETE
+        SearchPosting.objects.all().delete()
+        SearchDocument.objects.all().delete()
+
+        indexed = 0
+        for doc_type, rows in (
+            ('message', self.archived_message_rows()),
+            ('message', Message.objects.values_list('id', 'patient_id', 'timestamp', 'text')
+                .order_by('id').iterator(chunk_size=batch_size)),
+            ('request', PatientRequest.objects.values_list('id', 'patient_id', 'timestamp', 'details')
+                .order_by('id').iterator(chunk_size=batch_size)),
+        ):
+            batch = []
+            for row in rows:
+                batch.append((doc_type, *row))
+                if len(batch) >= batch_size:
+                    indexed += index_documents(batch, replace=False)
+                    batch = []
+            indexed += index_documents(batch, replace=False)
+            self.stdout.write(f"Indexed {indexed} documents so far")
+
+        cache.delete(STATS_CACHE_KEY)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {indexed} documents in {elapsed:.2f}s ({indexed / elapsed:.0f} docs/s)"
+        ))
+
+    def benchmark(self, count, options):
+        patient_ids = list(Patient.objects.order_by('id').values_list('id', flat=True)[:count // 1000 + 1])
+        if not patient_ids:
+            raise CommandError("The benchmark needs at least one patient.")
+
+        with transaction.atomic():
+            self.stdout.write(f"Indexing {count} synthetic documents for {len(patient_ids)} patients...")
+            started = time.perf_counter()
+            self.insert_synthetic(patient_ids, count, options['batch_size'])
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"Indexed in {elapsed:.1f}s ({count / elapsed:.0f} docs/s)")
+            cache.delete(STATS_CACHE_KEY)
+
+            for query in options['query'] or BENCHMARK_QUERIES:
+                for label, patient_id in (('all patients', None), ('one patient', patient_ids[0])):
+                    started = time.perf_counter()
+                    for _ in range(BENCHMARK_RUNS):
+                        results = search(query, patient=patient_id)
+                    elapsed = (time.perf_counter() - started) / BENCHMARK_RUNS
+                    self.stdout.write(f"{query!r} ({label}): {len(results)} results in {elapsed * 1000:.1f}ms")
+            self.stdout.write(self.style.SUCCESS(
+                f"{SearchDocument.objects.count()} documents and {SearchPosting.objects.count()} postings indexed"
+            ))
+            transaction.set_rollback(True)
+        cache.delete(STATS_CACHE_KEY)
+
+    def insert_synthetic(self, patient_ids, count, batch_size):
+        rng = random.Random(count)
+        now = timezone.now()
+        # Zipf-like weights, so common words have long posting lists as in real chat text
+        weights = [1 / rank for rank in range(1, len(SYNTHETIC_TERMS) + 1)]
+        first_id = (SearchDocument.objects.filter(doc_type='message').aggregate(last=Max('object_id'))['last'] or 0) + 1
+        batch = []
+        for object_id in range(first_id, first_id + count):
+            text = ' '.join(rng.choices(SYNTHETIC_TERMS, weights, k=rng.randint(4, 12)))
+            timestamp = now - timedelta(days=rng.random() * 365)
+            batch.append(('message', object_id, rng.choice(patient_ids), timestamp, text))
+            if len(batch) >= batch_size:
+                index_documents(batch, replace=False)
+                batch = []
+        index_documents(batch, replace=False)
+
+    def archived_message_rows(self):
+        for segment in MessageArchiveSegment.objects.order_by('id').iterator():
+            for block in iter_segment_blocks_reversed(segment):
+                for message in block:
+                    yield message['id'], segment.patient_id, message['timestamp'], message['text']
+
+    def run_query(self, query, options):
+        start = parse_datetime(options['start']) if options['start'] else None
+        end = parse_datetime(options['end']) if options['end'] else None
+        started = time.perf_counter()
+        results = search(query, patient=options['patient_id'], start=start, end=end)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"{query!r}: {len(results)} results in {elapsed * 1000:.1f}ms")
+        for result in results[:5]:
+            self.stdout.write(f"  [{result['type']} {result['id']}] {result['score']}: {result['snippet']}")
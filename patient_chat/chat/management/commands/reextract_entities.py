@@ -0,0 +1,329 @@
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.archive import find_archived_message, iter_segment_blocks_reversed
+from chat.extraction import extract_entities, extraction_llm, preprocess_message
+from chat.models import Message, MessageArchiveSegment, Patient
+from chat.neo4j_driver import get_graph_driver
+from chat.rate_limit import BACKGROUND, RateLimited
+from chat.resilience import CircuitOpen, ensure_pool_size
+from chat.retrieval import remember_entities
+
+STAGES = ('read', 'extract', 'graph', 'memory')
+# Pause before retrying a message whose extraction found no free LLM slot
+OVERLOAD_PAUSE_SECONDS = 1.0
+
+# Keyword rules for --offline, one per field of the extraction schema; group 1 is the value
+OFFLINE_PATTERNS = {
+    'medication': re.compile(
+        r'\b(?:taking|take|took|prescribed|on)\s+(?:my\s+)?([a-z][a-z-]{3,}(?:in|ol|ide|pril|statin|zole|mab|one|ate))\b'
+    ),
+    'frequency': re.compile(
+        r'\b((?:once|twice|three times|four times)\s+(?:a|per)\s+(?:day|week|month)|daily|weekly|every \d+ hours)\b'
+    ),
+    'date': re.compile(
+        r'\b((?:next|this|last)\s+(?:monday|tuesday|wednesday|thursday|friday|saturday|sunday|week|month)'
+        r'|today|tomorrow|yesterday|\d{4}-\d{2}-\d{2}'
+        r'|(?:january|february|march|april|may|june|july|august|september|october|november|december)\s+\d{1,2})\b'
+    ),
+    'time': re.compile(r'\b(\d{1,2}(?::\d{2})?\s*(?:am|pm)|noon|midnight|morning|evening|night)\b'),
+    'symptom': re.compile(
+        r'\b(headaches?|fever|cough|nausea|dizziness|dizzy|fatigue|tired|pain|rash|swelling|'
+        r'shortness of breath|insomnia|vomiting|diarrhea|chills|sore throat)\b'
+    ),
+    'diet': re.compile(r'\b(low[- ](?:salt|sodium|carb|fat|sugar)|vegetarian|vegan|keto|gluten[- ]free|fasting)\b'),
+    'lab_test': re.compile(
+        r'\b(blood test|cholesterol|hba1c|a1c|glucose test|cbc|lipid panel|x-ray|mri|urine test|biopsy)\b'
+    ),
+    'vital_sign': re.compile(r'\b(blood pressure|heart rate|pulse|temperature|oxygen|respiratory rate|bmi)\b'),
+}
+
+
+class OfflineExtractionLLM:
+    # Stands in for the chat model: answers the extraction prompt with a JSON block built
+    # from keyword rules, so the real prompt and output parser still run without network calls.
+    # `latency` (seconds) simulates the model's response time for benchmarking.
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def __call__(self, messages):
+        if self.latency:
+            time.sleep(self.latency)
+        text = messages[-1].content.rsplit('Message:', 1)[-1].lower()
+        entities = {}
+        for field, pattern in OFFLINE_PATTERNS.items():
+            match = pattern.search(text)
+            entities[field] = match.group(1) if match else ""
+        return SimpleNamespace(content=f"```json\n{json.dumps(entities)}\n```")
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-run entity extraction over stored patient messages and write the results to the "
+        "knowledge graph in batches. Progress is checkpointed so an interrupted run can resume."
+    )
+    # The URL checks import the chat views, which refuse to load without LLM_API_KEY;
+    # --offline runs must work without one
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offline', action='store_true',
+                            help="Use the keyword-based stub instead of calling the LLM.")
+        parser.add_argument('--stub-latency', type=float, default=0.0, metavar='MS',
+                            help="Simulated response time of the offline stub, in milliseconds.")
+        parser.add_argument('--workers', type=int, default=8,
+                            help="Concurrent extractions. Live calls also share the LLM_MAX_CONCURRENCY "
+                                 "background slots with the chat app.")
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help="Messages per extraction batch and graph transaction.")
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Rows fetched per database round trip.")
+        parser.add_argument('--patient-id', type=int)
+        parser.add_argument('--limit', type=int, help="Stop after this many messages.")
+        parser.add_argument('--checkpoint', default='reextract_entities.checkpoint')
+        parser.add_argument('--restart', action='store_true', help="Ignore an existing checkpoint.")
+        parser.add_argument('--failed', help="Where messages whose extraction failed are listed, one JSON object "
+                                             "per line (default: <checkpoint>.failed).")
+        parser.add_argument('--retry-failed', action='store_true',
+                            help="Re-extract only the messages listed in the failures file.")
+        parser.add_argument('--skip-graph', action='store_true', help="Do not write to Neo4j.")
+        parser.add_argument('--skip-memory', action='store_true', help="Do not update the retrieval index.")
+
+    def handle(self, *args, **options):
+        checkpoint_path = options['checkpoint']
+        failed_path = options['failed'] or f"{checkpoint_path}.failed"
+        scope = {'patient_id': options['patient_id']}
+        if options['retry_failed']:
+            # Only the messages listed in the failures file; progress is not checkpointed
+            checkpoint = None
+            retrying = self.read_failures(failed_path)
+            attempted = set()
+            rows = self.failed_rows(retrying, attempted)
+            self.stdout.write(f"Retrying {len(retrying)} failed messages from {failed_path}")
+        else:
+            checkpoint = {} if options['restart'] else self.read_checkpoint(checkpoint_path, scope)
+            if checkpoint.get('phase'):
+                self.stdout.write(f"Resuming after {self.describe(checkpoint)} from {checkpoint_path}")
+            rows = self.stored_rows(checkpoint, options)
+        if options['limit']:
+            rows = islice(rows, options['limit'])
+
+        if options['offline']:
+            llm = OfflineExtractionLLM(options['stub_latency'] / 1000)
+            admission = None
+        else:
+            try:
+                llm = extraction_llm()
+            except ValueError as error:
+                raise CommandError(f"{error} Use --offline to run without the LLM.")
+            # Live calls take background LLM slots, so interactive chat keeps its reserved share
+            admission = BACKGROUND
+        # Each worker waits on one provider call at a time; size the shared call pool to match
+        ensure_pool_size(options['workers'])
+        graph = None if options['skip_graph'] else get_graph_driver()
+        patient_names = {}
+        timings = dict.fromkeys(STAGES, 0.0)
+        processed = 0
+        with_entities = 0
+        failures = []
+        started = time.perf_counter()
+
+        def extract(text):
+            while True:
+                try:
+                    return extract_entities(preprocess_message(text), llm=llm, admission=admission)
+                except RateLimited:
+                    # The chat app is busy: wait for a slot rather than checkpoint past the message
+                    time.sleep(OVERLOAD_PAUSE_SECONDS)
+                except CircuitOpen:
+                    # The provider is down: the batch is abandoned before its checkpoint
+                    raise
+                except Exception as error:
+                    return error
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                stage_started = time.perf_counter()
+                batch = list(islice(rows, options['batch_size']))
+                if not batch:
+                    break
+                self.load_patient_names(patient_names, {row[2] for row in batch})
+                timings['read'] += time.perf_counter() - stage_started
+
+                stage_started = time.perf_counter()
+                # map() keeps at most one batch in flight, so memory stays bounded
+                try:
+                    extracted = list(pool.map(extract, [row[3] for row in batch]))
+                except CircuitOpen:
+                    raise CommandError(self.stopped(checkpoint, "the LLM circuit breaker is open"))
+                batch_failures = [
+                    {'message_id': message_id, 'patient_id': patient_id, 'error': repr(entities)}
+                    for (_position, message_id, patient_id, _text), entities in zip(batch, extracted)
+                    if isinstance(entities, Exception)
+                ]
+                if len(batch_failures) == len(batch):
+                    raise CommandError(self.stopped(
+                        checkpoint, f"every extraction in the batch failed ({batch_failures[-1]['error']})"
+                    ))
+                results = [
+                    (patient_id, entities)
+                    for (_position, _id, patient_id, _text), entities in zip(batch, extracted)
+                    if not isinstance(entities, Exception) and entities and any(entities.values())
+                ]
+                timings['extract'] += time.perf_counter() - stage_started
+
+                stage_started = time.perf_counter()
+                if graph is not None:
+                    graph.save_entities_batch([(patient_names[patient_id], entities) for patient_id, entities in results])
+                timings['graph'] += time.perf_counter() - stage_started
+
+                stage_started = time.perf_counter()
+                if not options['skip_memory']:
+                    for patient_id, entities in results:
+                        remember_entities(patient_id, entities)
+                timings['memory'] += time.perf_counter() - stage_started
+
+                processed += len(batch)
+                with_entities += len(results)
+                failures.extend(batch_failures)
+                position = batch[-1][0]
+                if checkpoint is not None:
+                    # Failures are recorded before the checkpoint moves past them
+                    self.append_failures(failed_path, batch_failures)
+                    checkpoint = {**position, 'processed': checkpoint.get('processed', 0) + len(batch)}
+                    self.write_checkpoint(checkpoint_path, scope, checkpoint)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(
+                    f"Up to {self.describe(position)}: {processed} processed ({processed / elapsed:.0f} msg/s)"
+                )
+
+        if options['retry_failed']:
+            # Messages that failed again, or were not reached because of --limit, stay listed
+            still_failing = [entry for message_id, entry in retrying.items() if message_id not in attempted]
+            self.write_failures(failed_path, still_failing + failures)
+
+        elapsed = time.perf_counter() - started
+        rate = processed / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-extracted {processed} messages ({with_entities} with entities, {len(failures)} failed) "
+            f"in {elapsed:.1f}s ({rate:.0f} msg/s)"
+        ))
+        if failures:
+            self.stdout.write(f"Failed messages are listed in {failed_path}; rerun with --retry-failed.")
+        self.stdout.write("Stage time: " + ", ".join(f"{stage} {timings[stage]:.2f}s" for stage in STAGES))
+        # A run cut short by --limit keeps its checkpoint so the next run continues from it
+        finished = not options['limit'] or processed < options['limit']
+        if checkpoint is not None and finished and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    def stored_rows(self, checkpoint, options):
+        # (checkpoint position, message id, patient id, text) for every patient message: the
+        # hot table by id, then the archive segment by segment. Archiving during a run can
+        # only make a message come up twice, never be skipped.
+        if checkpoint.get('phase', 'hot') == 'hot':
+            messages = Message.objects.filter(
+                sender='patient', patient__isnull=False, id__gt=checkpoint.get('last_message_id', 0)
+            )
+            if options['patient_id']:
+                messages = messages.filter(patient_id=options['patient_id'])
+            for message_id, patient_id, text in messages.order_by('id').values_list(
+                    'id', 'patient_id', 'text').iterator(chunk_size=options['chunk_size']):
+                yield {'phase': 'hot', 'last_message_id': message_id}, message_id, patient_id, text
+            checkpoint = {}
+
+        segments = MessageArchiveSegment.objects.filter(id__gte=checkpoint.get('segment_id', 0))
+        if options['patient_id']:
+            segments = segments.filter(patient_id=options['patient_id'])
+        for segment_id in segments.order_by('id').values_list('id', flat=True):
+            # One segment's payload in memory at a time
+            segment = MessageArchiveSegment.objects.get(pk=segment_id)
+            skip = checkpoint.get('segment_offset', 0) if segment_id == checkpoint.get('segment_id') else 0
+            offset = 0
+            for block in iter_segment_blocks_reversed(segment):
+                for message in block:
+                    offset += 1
+                    if offset <= skip or message['sender'] != 'patient':
+                        continue
+                    position = {'phase': 'archive', 'segment_id': segment_id, 'segment_offset': offset}
+                    yield position, message['id'], segment.patient_id, message['text']
+
+    def failed_rows(self, failures, attempted):
+        # Messages deleted since they failed are dropped from the list
+        for message_id, entry in failures.items():
+            attempted.add(message_id)
+            text = Message.objects.filter(pk=message_id).values_list('text', flat=True).first()
+            if text is None:
+                archived = find_archived_message(entry['patient_id'], message_id)
+                text = archived['text'] if archived else None
+            if text is not None:
+                yield {}, message_id, entry['patient_id'], text
+
+    def describe(self, position):
+        if position.get('phase') == 'archive':
+            return f"archive segment {position['segment_id']} (message {position['segment_offset']})"
+        if position.get('phase') == 'hot':
+            return f"message {position['last_message_id']}"
+        return "the failed messages"
+
+    def stopped(self, checkpoint, reason):
+        resume = f"from {self.describe(checkpoint)}" if checkpoint and checkpoint.get('phase') else "from the start"
+        return f"Stopped because {reason}; the batch was not checkpointed. Rerun to resume {resume}."
+
+    def load_patient_names(self, patient_names, patient_ids):
+        missing = patient_ids - patient_names.keys()
+        for patient_id, first_name, last_name in Patient.objects.filter(pk__in=missing).values_list(
+                'id', 'first_name', 'last_name'):
+            patient_names[patient_id] = f"{first_name} {last_name}"
+
+    def read_checkpoint(self, checkpoint_path, scope):
+        if not os.path.exists(checkpoint_path):
+            return {}
+        with open(checkpoint_path) as handle:
+            checkpoint = json.load(handle)
+        if checkpoint.get('scope') != scope:
+            raise CommandError(f"{checkpoint_path} belongs to another run; use --restart or --checkpoint.")
+        checkpoint.pop('scope')
+        # Checkpoints written before archived messages were included only cover the hot table
+        if 'last_message_id' in checkpoint and 'phase' not in checkpoint:
+            checkpoint['phase'] = 'hot'
+        return checkpoint
+
+    def write_checkpoint(self, checkpoint_path, scope, checkpoint):
+        temporary = f"{checkpoint_path}.tmp"
+        with open(temporary, 'w') as handle:
+            json.dump({'scope': scope, **checkpoint}, handle)
+        os.replace(temporary, checkpoint_path)
+
+    def read_failures(self, failed_path):
+        # The latest entry per message id, in file order
+        failures = {}
+        if os.path.exists(failed_path):
+            with open(failed_path) as handle:
+                for line in handle:
+                    if line.strip():
+                        entry = json.loads(line)
+                        failures[entry['message_id']] = entry
+        return failures
+
+    def append_failures(self, failed_path, failures):
+        if failures:
+            with open(failed_path, 'a') as handle:
+                for entry in failures:
+                    handle.write(json.dumps(entry) + '\n')
+
+    def write_failures(self, failed_path, failures):
+        if not failures:
+            if os.path.exists(failed_path):
+                os.remove(failed_path)
+            return
+        temporary = f"{failed_path}.tmp"
+        with open(temporary, 'w') as handle:
+            for entry in failures:
+                handle.write(json.dumps(entry) + '\n')
+        os.replace(temporary, failed_path)
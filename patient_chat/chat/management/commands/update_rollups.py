@@ -0,0 +1,132 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from chat.analytics import DEFAULT_BATCH_SIZE, dashboard, reset_rollups, update_rollups
+from chat.models import Message, MessageArchiveSegment, Patient, PatientRequest
+from chat.replies import BUSY_REPLY, LLM_ERROR_REPLY, LLM_REFUSAL_REPLY, OFF_TOPIC_REPLY
+
+# Share of synthetic bot replies per canned reply; the rest are ordinary answers
+SYNTHETIC_REPLIES = [
+    (OFF_TOPIC_REPLY, 0.05), (BUSY_REPLY, 0.02), (LLM_ERROR_REPLY, 0.03), (LLM_REFUSAL_REPLY, 0.01),
+]
+SYNTHETIC_DAYS = 90
+
+
+class Command(BaseCommand):
+    help = (
+        "Count messages and requests written since the last run into the daily analytics "
+        "rollups read by the analytics dashboard."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Source rows aggregated per transaction.")
+        parser.add_argument('--rebuild', action='store_true',
+                            help="Drop the rollups and recount all messages and requests.")
+        parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                            help="Time the rollup job and dashboard on N synthetic messages. "
+                                 "Everything is rolled back afterwards.")
+
+    def handle(self, *args, **options):
+        if options['benchmark']:
+            self.benchmark(options['benchmark'], options['batch_size'])
+            return
+        if options['rebuild']:
+            if MessageArchiveSegment.objects.exists():
+                self.stderr.write("Archived messages are not in the message table and will not be recounted.")
+            reset_rollups()
+
+        started = time.perf_counter()
+        counted = update_rollups(batch_size=options['batch_size'])
+        elapsed = time.perf_counter() - started
+        rows = sum(counted.values())
+        self.stdout.write(self.style.SUCCESS(
+            f"Rolled up {counted['messages']} messages and {counted['requests']} requests in {elapsed:.2f}s "
+            f"({rows / elapsed if elapsed else 0:.0f} rows/s)"
+        ))
+
+    def benchmark(self, count, batch_size):
+        patient_ids = list(Patient.objects.values_list('id', flat=True))
+        if not patient_ids:
+            raise CommandError("The benchmark needs at least one patient.")
+
+        with transaction.atomic():
+            # Bring the rollups up to date first so only synthetic rows are timed
+            update_rollups(batch_size=batch_size)
+
+            self.stdout.write(f"Inserting {count} synthetic messages...")
+            self.insert_synthetic(patient_ids, count)
+            started = time.perf_counter()
+            counted = update_rollups(batch_size=batch_size, now=timezone.now() + timedelta(days=1))
+            elapsed = time.perf_counter() - started
+            rows = sum(counted.values())
+            self.stdout.write(
+                f"Full pass: {rows} rows in {elapsed:.2f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)"
+            )
+
+            delta = max(count // 100, 1)
+            self.insert_synthetic(patient_ids, delta)
+            started = time.perf_counter()
+            counted = update_rollups(batch_size=batch_size, now=timezone.now() + timedelta(days=1))
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"Incremental pass: {sum(counted.values())} new rows in {elapsed * 1000:.1f}ms")
+
+            runs = 20
+            start = timezone.localdate() - timedelta(days=SYNTHETIC_DAYS)
+            for label, patient_id in (('clinic', None), ('one patient', patient_ids[0])):
+                started = time.perf_counter()
+                for _ in range(runs):
+                    dashboard(start=start, patient_id=patient_id)
+                elapsed = (time.perf_counter() - started) / runs
+                self.stdout.write(f"Dashboard over {SYNTHETIC_DAYS} days ({label}): {elapsed * 1000:.1f}ms per query")
+            self.stdout.write(self.style.SUCCESS(
+                f"{Message.objects.count()} messages and {PatientRequest.objects.count()} requests in the raw tables"
+            ))
+            transaction.set_rollback(True)
+
+    def insert_synthetic(self, patient_ids, count):
+        rng = random.Random(count)
+        now = timezone.now()
+        replies, weights = zip(*SYNTHETIC_REPLIES)
+        messages = []
+        for number in range(count):
+            patient_id = rng.choice(patient_ids)
+            if number % 2 == 0:
+                messages.append(Message(patient_id=patient_id, sender='patient', text="I have a headache today"))
+                continue
+            roll = rng.random()
+            text = "Please rest and drink plenty of water."
+            for reply, weight in zip(replies, weights):
+                if roll < weight:
+                    text = reply
+                    break
+                roll -= weight
+            messages.append(Message(patient_id=patient_id, sender='bot', text=text))
+        created = Message.objects.bulk_create(messages, batch_size=5000)
+        requests = PatientRequest.objects.bulk_create([
+            PatientRequest(
+                patient_id=rng.choice(patient_ids), request_type=rng.choice(['appointment', 'medication']),
+                details="Synthetic request",
+            )
+            for _ in range(count // 20)
+        ], batch_size=5000)
+
+        # timestamp is auto_now_add, so spread the rows over past days after inserting them
+        for rows, model in ((created, Message), (requests, PatientRequest)):
+            ids = sorted(row.pk for row in rows if row.pk is not None)
+            if not ids:
+                ids = list(model.objects.order_by('-id').values_list('id', flat=True)[:len(rows)])[::-1]
+            if not ids:
+                continue
+            per_day = -(-len(ids) // SYNTHETIC_DAYS)
+            for day in range(SYNTHETIC_DAYS):
+                chunk = ids[day * per_day:(day + 1) * per_day]
+                if chunk:
+                    model.objects.filter(id__gte=chunk[0], id__lte=chunk[-1]).update(
+                        timestamp=now - timedelta(days=SYNTHETIC_DAYS - day, hours=rng.random() * 12)
+                    )
@@ -0,0 +1,239 @@
+# Time-series measurements (vitals, labs, weight) and their rolling summaries.
+#
+# Readings are appended to Measurement. MeasurementSummary keeps, per patient and
+# kind, the latest reading plus 7/30-day count, min, max, mean and a least-squares
+# trend. Summaries are recomputed for a batch of patients at a time: the window's
+# rows are loaded into NumPy arrays, sorted by (group, time) and reduced per group
+# with ufunc.reduceat, so the cost is a few array passes per batch, not per row.
+from datetime import timedelta
+
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.utils import timezone
+
+from .models import Measurement, MeasurementSummary, Patient
+
+WINDOWS = (7, 30)
+TREND_WINDOW = 30
+SECONDS_PER_DAY = 86400.0
+SUMMARY_FIELDS = [
+    'unit', 'latest_value', 'latest_at',
+    'count_7d', 'min_7d', 'max_7d', 'mean_7d',
+    'count_30d', 'min_30d', 'max_30d', 'mean_30d',
+    'trend_per_day', 'updated_at',
+]
+# Free-text Patient fields and the measurement kinds that replace them in the prompt;
+# a field is only dropped once one of its kinds has a summary
+RAW_MEASUREMENT_FIELDS = {
+    'weight': {'weight'},
+    'vital_signs': {
+        'systolic_bp', 'diastolic_bp', 'heart_rate', 'temperature', 'respiratory_rate', 'oxygen_saturation',
+    },
+    'lab_tests': {'hba1c', 'glucose', 'cholesterol', 'ldl', 'hdl', 'triglycerides', 'creatinine'},
+}
+# Patient.weight is kept in kilograms
+PATIENT_WEIGHT_UNIT = 'kg'
+# Summaries older than this are recomputed before they reach the prompt, so the 7/30-day
+# windows still move forward when the refresh job has not run
+SUMMARY_MAX_AGE = timedelta(days=1)
+
+
+def record_measurements(patient, readings, refresh=True):
+    # readings: iterable of (kind, value, unit, timestamp)
+    rows = [
+        Measurement(patient=patient, kind=kind, value=float(value), unit=unit or '', timestamp=timestamp)
+        for kind, value, unit, timestamp in readings
+    ]
+    Measurement.objects.bulk_create(rows, batch_size=1000)
+    if refresh and rows:
+        refresh_summaries([patient.pk], kinds={row.kind for row in rows})
+    return len(rows)
+
+
+def record_patient_weights(patients, now=None):
+    # Saved Patients (from the post_save signal or a bulk import): every new or changed
+    # weight becomes a reading, with one summary refresh for the whole batch
+    weighted = {patient.pk: float(patient.weight) for patient in patients
+                if patient.pk is not None and patient.weight is not None}
+    if not weighted:
+        return 0
+    latest_weight = Measurement.objects.filter(patient=OuterRef('pk'), kind='weight').order_by('-timestamp')
+    latest = dict(
+        Patient.objects.filter(pk__in=weighted)
+        .annotate(latest_weight=Subquery(latest_weight.values('value')[:1]))
+        .values_list('pk', 'latest_weight')
+    )
+    timestamp = now or timezone.now()
+    rows = [
+        Measurement(patient_id=patient_id, kind='weight', value=weight, unit=PATIENT_WEIGHT_UNIT, timestamp=timestamp)
+        for patient_id, weight in weighted.items()
+        if latest.get(patient_id) != weight
+    ]
+    Measurement.objects.bulk_create(rows, batch_size=1000)
+    if rows:
+        refresh_summaries([row.patient_id for row in rows], kinds={'weight'})
+    return len(rows)
+
+
+def _grouped_stats(starts, values, mask):
+    # count/min/max/mean per group over the rows where mask is True
+    count = np.add.reduceat(mask.astype(np.int64), starts)
+    minimum = np.minimum.reduceat(np.where(mask, values, np.inf), starts)
+    maximum = np.maximum.reduceat(np.where(mask, values, -np.inf), starts)
+    total = np.add.reduceat(np.where(mask, values, 0.0), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    return count, minimum, maximum, mean
+
+
+def _grouped_slope(starts, days, values, mask):
+    # Least-squares slope (value units per day) per group, from the summed moments
+    x = np.where(mask, days, 0.0)
+    y = np.where(mask, values, 0.0)
+    n = np.add.reduceat(mask.astype(np.float64), starts)
+    sx = np.add.reduceat(x, starts)
+    sy = np.add.reduceat(y, starts)
+    sxy = np.add.reduceat(x * y, starts)
+    sxx = np.add.reduceat(x * x, starts)
+    denominator = n * sxx - sx * sx
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n * sxy - sx * sy) / denominator
+    return np.where((n >= 2) & (denominator > 1e-12), slope, np.nan)
+
+
+def _none_if_nan(value):
+    value = float(value)
+    return None if np.isnan(value) or np.isinf(value) else value
+
+
+def compute_summaries(patient_ids, kinds=None, now=None):
+    now = now or timezone.now()
+    window_start = now - timedelta(days=max(WINDOWS))
+    rows = Measurement.objects.filter(patient_id__in=patient_ids, timestamp__gte=window_start)
+    if kinds:
+        rows = rows.filter(kind__in=kinds)
+    rows = list(rows.values_list('patient_id', 'kind', 'value', 'unit', 'timestamp'))
+
+    summaries = {}
+    if rows:
+        patient_column, kind_column, value_column, unit_column, time_column = zip(*rows)
+        groups = {}
+        codes = np.fromiter(
+            (groups.setdefault(key, len(groups)) for key in zip(patient_column, kind_column)),
+            dtype=np.int64, count=len(rows),
+        )
+        values = np.asarray(value_column, dtype=np.float64)
+        days = np.fromiter(
+            ((timestamp - now).total_seconds() / SECONDS_PER_DAY for timestamp in time_column),
+            dtype=np.float64, count=len(rows),
+        )
+
+        order = np.lexsort((days, codes))
+        codes, values, days = codes[order], values[order], days[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        ends = np.r_[starts[1:], len(codes)] - 1
+
+        stats = {window: _grouped_stats(starts, values, days >= -window) for window in WINDOWS}
+        slopes = _grouped_slope(starts, days, values, days >= -TREND_WINDOW)
+
+        keys = list(groups)
+        for position, end in enumerate(ends):
+            group = int(codes[starts[position]])
+            patient_id, kind = keys[group]
+            latest_row = int(order[end])
+            summary = {
+                'unit': unit_column[latest_row],
+                'latest_value': float(values[end]),
+                'latest_at': time_column[latest_row],
+                'trend_per_day': _none_if_nan(slopes[position]),
+            }
+            for window, (count, minimum, maximum, mean) in stats.items():
+                summary[f'count_{window}d'] = int(count[position])
+                summary[f'min_{window}d'] = _none_if_nan(minimum[position])
+                summary[f'max_{window}d'] = _none_if_nan(maximum[position])
+                summary[f'mean_{window}d'] = _none_if_nan(mean[position])
+            summaries[(patient_id, kind)] = summary
+
+    # Kinds with no reading inside the window still get their latest value
+    latest = Measurement.objects.filter(patient_id__in=patient_ids)
+    if kinds:
+        latest = latest.filter(kind__in=kinds)
+    for group in latest.values('patient_id', 'kind').annotate(latest_at=Max('timestamp')):
+        key = (group['patient_id'], group['kind'])
+        if key in summaries:
+            continue
+        value, unit = Measurement.objects.filter(
+            patient_id=key[0], kind=key[1], timestamp=group['latest_at']
+        ).values_list('value', 'unit').first()
+        summary = {'unit': unit, 'latest_value': value, 'latest_at': group['latest_at'], 'trend_per_day': None}
+        for window in WINDOWS:
+            summary.update({
+                f'count_{window}d': 0, f'min_{window}d': None, f'max_{window}d': None, f'mean_{window}d': None,
+            })
+        summaries[key] = summary
+    return summaries
+
+
+def refresh_summaries(patient_ids, kinds=None, now=None):
+    summaries = compute_summaries(patient_ids, kinds=kinds, now=now)
+    updated_at = timezone.now()
+    objects = [
+        MeasurementSummary(patient_id=patient_id, kind=kind, updated_at=updated_at, **summary)
+        for (patient_id, kind), summary in summaries.items()
+    ]
+    if not objects:
+        return 0
+    options = {'update_conflicts': True, 'update_fields': SUMMARY_FIELDS}
+    # MySQL upserts on any unique key and rejects an explicit conflict target
+    if connection.features.supports_update_conflicts_with_target:
+        options['unique_fields'] = ['patient', 'kind']
+    with transaction.atomic():
+        MeasurementSummary.objects.bulk_create(objects, batch_size=1000, **options)
+    return len(objects)
+
+
+def _format_number(value):
+    return f"{value:.1f}".rstrip('0').rstrip('.') if value is not None else '?'
+
+
+def replaced_raw_fields(summaries):
+    # The free-text Patient fields that the given summaries stand in for
+    kinds = {summary.kind for summary in summaries}
+    return {field for field, field_kinds in RAW_MEASUREMENT_FIELDS.items() if kinds & field_kinds}
+
+
+def trend_summaries(patient, now=None):
+    now = now or timezone.now()
+    summaries = list(MeasurementSummary.objects.filter(patient=patient).order_by('kind'))
+    if any(summary.updated_at < now - SUMMARY_MAX_AGE for summary in summaries):
+        refresh_summaries([patient.pk], now=now)
+        summaries = list(MeasurementSummary.objects.filter(patient=patient).order_by('kind'))
+    return summaries
+
+
+def format_trends(summaries):
+    # Compact, prompt-ready text: one clause per measurement kind
+    parts = []
+    for summary in summaries:
+        unit = f" {summary.unit}" if summary.unit else ''
+        text = (
+            f"{summary.kind.replace('_', ' ')} {_format_number(summary.latest_value)}{unit} "
+            f"on {summary.latest_at:%Y-%m-%d}"
+        )
+        if summary.count_30d > 1:
+            text += (
+                f" (30-day range {_format_number(summary.min_30d)}-{_format_number(summary.max_30d)}, "
+                f"mean {_format_number(summary.mean_30d)}"
+            )
+            if summary.trend_per_day is not None:
+                weekly = summary.trend_per_day * 7
+                direction = 'stable' if abs(weekly) < 0.05 else ('rising' if weekly > 0 else 'falling')
+                text += f", {direction} {weekly:+.2f}{unit}/week" if direction != 'stable' else ", stable"
+            text += ")"
+        parts.append(text)
+    return "; ".join(parts)
+
+
+def summarize_trends(patient, now=None):
+    return format_trends(trend_summaries(patient, now=now))
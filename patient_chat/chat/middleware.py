@@ -0,0 +1,46 @@
+import threading
+
+from django.db.backends.signals import connection_created
+
+from .neo4j_driver import get_graph_driver
+
+_lock = threading.Lock()
+_request_stats = {
+    'requests': 0,
+    'db_connections_created': 0,
+    'graph_sessions_opened': 0,
+}
+_local = threading.local()
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    with _lock:
+        _request_stats['db_connections_created'] += 1
+
+
+connection_created.connect(_on_connection_created)
+
+
+def connection_stats():
+    with _lock:
+        stats = dict(_request_stats)
+    requests = stats['requests'] or 1
+    stats['db_connections_per_request'] = round(stats['db_connections_created'] / requests, 3)
+    stats['graph_sessions_per_request'] = round(stats['graph_sessions_opened'] / requests, 3)
+    return stats
+
+
+class GraphSessionMiddleware:
+    # Shares one Neo4j session across all graph calls made while handling a request,
+    # and counts DB connections and graph sessions opened per request
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.graph_driver = get_graph_driver()
+
+    def __call__(self, request):
+        with self.graph_driver.request_scope() as scope:
+            response = self.get_response(request)
+        with _lock:
+            _request_stats['requests'] += 1
+            _request_stats['graph_sessions_opened'] += scope['sessions_opened']
+        return response
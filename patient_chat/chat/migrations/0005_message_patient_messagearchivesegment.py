@@ -0,0 +1,79 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def assign_messages_to_patient(apps, schema_editor):
+    # Messages predate the patient link; the app has always served a single patient
+    Message = apps.get_model("chat", "Message")
+    Patient = apps.get_model("chat", "Patient")
+    patient = Patient.objects.order_by("id").first()
+    if patient is not None:
+        Message.objects.filter(patient__isnull=True).update(patient=patient)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0004_patientrequest"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MessageArchiveSegment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("first_message_id", models.BigIntegerField()),
+                ("last_message_id", models.BigIntegerField()),
+                ("start_time", models.DateTimeField()),
+                ("end_time", models.DateTimeField()),
+                ("message_count", models.IntegerField()),
+                ("codec", models.CharField(max_length=10)),
+                ("raw_size", models.BigIntegerField()),
+                ("data", models.BinaryField()),
+                ("block_index", models.JSONField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="patient",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="chat.patient",
+            ),
+        ),
+        migrations.RunPython(assign_messages_to_patient, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["patient", "timestamp"], name="chat_messag_patient_6cf1ec_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="messagearchivesegment",
+            name="patient",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="chat.patient",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="messagearchivesegment",
+            index=models.Index(
+                fields=["patient", "end_time"], name="chat_messag_patient_77b7b2_idx"
+            ),
+        ),
+    ]
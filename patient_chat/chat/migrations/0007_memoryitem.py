@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0006_searchdocument_searchposting"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MemoryItem",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "source",
+                    models.CharField(
+                        choices=[("message", "Message"), ("fact", "Knowledge Fact")],
+                        max_length=10,
+                    ),
+                ),
+                ("source_key", models.CharField(max_length=100)),
+                ("text", models.TextField()),
+                ("vector", models.BinaryField()),
+                ("token_count", models.IntegerField()),
+                ("timestamp", models.DateTimeField()),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "patient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="chat.patient"
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["patient", "updated_at"],
+                        name="chat_memory_patient_608360_idx",
+                    )
+                ],
+                "unique_together": {("patient", "source", "source_key")},
+            },
+        ),
+    ]
@@ -0,0 +1,82 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0007_memoryitem"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Measurement",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("kind", models.CharField(max_length=50)),
+                ("value", models.FloatField()),
+                ("unit", models.CharField(blank=True, max_length=20)),
+                ("timestamp", models.DateTimeField()),
+                (
+                    "patient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="chat.patient"
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["patient", "kind", "timestamp"],
+                        name="chat_measur_patient_798b92_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="MeasurementSummary",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("kind", models.CharField(max_length=50)),
+                ("unit", models.CharField(blank=True, max_length=20)),
+                ("latest_value", models.FloatField()),
+                ("latest_at", models.DateTimeField()),
+                ("count_7d", models.IntegerField(default=0)),
+                ("min_7d", models.FloatField(blank=True, null=True)),
+                ("max_7d", models.FloatField(blank=True, null=True)),
+                ("mean_7d", models.FloatField(blank=True, null=True)),
+                ("count_30d", models.IntegerField(default=0)),
+                ("min_30d", models.FloatField(blank=True, null=True)),
+                ("max_30d", models.FloatField(blank=True, null=True)),
+                ("mean_30d", models.FloatField(blank=True, null=True)),
+                ("trend_per_day", models.FloatField(blank=True, null=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "patient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="chat.patient"
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("patient", "kind")},
+            },
+        ),
+    ]
@@ -0,0 +1,106 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0008_measurement_measurementsummary"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DailyMessageTotal",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField(unique=True)),
+                ("patient_messages", models.IntegerField(default=0)),
+                ("bot_messages", models.IntegerField(default=0)),
+                ("off_topic", models.IntegerField(default=0)),
+                ("busy_replies", models.IntegerField(default=0)),
+                ("llm_errors", models.IntegerField(default=0)),
+                ("llm_refusals", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="RollupWatermark",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("source", models.CharField(max_length=20, unique=True)),
+                ("last_id", models.BigIntegerField(default=0)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="DailyRequestRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("request_type", models.CharField(max_length=20)),
+                ("count", models.IntegerField(default=0)),
+            ],
+            options={
+                "unique_together": {("day", "request_type")},
+            },
+        ),
+        migrations.CreateModel(
+            name="DailyMessageRollup",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("day", models.DateField()),
+                ("patient_messages", models.IntegerField(default=0)),
+                ("bot_messages", models.IntegerField(default=0)),
+                ("off_topic", models.IntegerField(default=0)),
+                ("busy_replies", models.IntegerField(default=0)),
+                ("llm_errors", models.IntegerField(default=0)),
+                ("llm_refusals", models.IntegerField(default=0)),
+                (
+                    "patient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="chat.patient"
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["patient", "day"], name="chat_dailym_patient_0f00af_idx"
+                    )
+                ],
+                "unique_together": {("day", "patient")},
+            },
+        ),
+    ]
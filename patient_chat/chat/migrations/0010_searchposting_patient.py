@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_patient_to_postings(apps, schema_editor):
+    # Existing postings take their document's patient; rebuild_search_index does the same
+    SearchDocument = apps.get_model("chat", "SearchDocument")
+    SearchPosting = apps.get_model("chat", "SearchPosting")
+    SearchPosting.objects.update(
+        patient_id=Subquery(
+            SearchDocument.objects.filter(pk=OuterRef("document_id")).values("patient_id")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0009_daily_rollups"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="searchposting",
+            name="patient",
+            field=models.ForeignKey(
+                blank=True,
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="chat.patient",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="searchposting",
+            index=models.Index(
+                fields=["patient", "term", "document"],
+                name="chat_search_patient_a14ae1_idx",
+            ),
+        ),
+        migrations.RunPython(copy_patient_to_postings, migrations.RunPython.noop),
+    ]
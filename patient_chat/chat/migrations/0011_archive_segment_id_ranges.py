@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def recompute_id_ranges(apps, schema_editor):
+    # Segments cut in (timestamp, id) order stored their first and last message's ids;
+    # find_archived_message needs the lowest and highest id instead
+    from chat.archive import iter_segment_blocks_reversed
+
+    MessageArchiveSegment = apps.get_model("chat", "MessageArchiveSegment")
+    for segment_id in MessageArchiveSegment.objects.values_list("id", flat=True):
+        segment = MessageArchiveSegment.objects.get(pk=segment_id)
+        ids = [
+            message["id"]
+            for block in iter_segment_blocks_reversed(segment)
+            for message in block
+        ]
+        if ids and (segment.first_message_id, segment.last_message_id) != (
+            min(ids),
+            max(ids),
+        ):
+            MessageArchiveSegment.objects.filter(pk=segment_id).update(
+                first_message_id=min(ids), last_message_id=max(ids)
+            )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0010_searchposting_patient"),
+    ]
+
+    operations = [
+        migrations.RunPython(recompute_id_ranges, migrations.RunPython.noop),
+    ]
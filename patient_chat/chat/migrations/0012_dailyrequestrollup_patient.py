@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def recount_requests(apps, schema_editor):
+    # Existing rollups have no patient: drop them and rewind the watermark so the next
+    # update_rollups counts every request again, per patient
+    apps.get_model("chat", "DailyRequestRollup").objects.all().delete()
+    apps.get_model("chat", "RollupWatermark").objects.filter(source="requests").delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0011_archive_segment_id_ranges"),
+    ]
+
+    operations = [
+        migrations.RunPython(recount_requests, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name="dailyrequestrollup",
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name="dailyrequestrollup",
+            name="patient",
+            field=models.ForeignKey(
+                default=0,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="chat.patient",
+            ),
+            preserve_default=False,
+        ),
+        migrations.AlterUniqueTogether(
+            name="dailyrequestrollup",
+            unique_together={("day", "patient", "request_type")},
+        ),
+        migrations.AddIndex(
+            model_name="dailyrequestrollup",
+            index=models.Index(
+                fields=["patient", "day"], name="chat_dailyr_patient_44c90a_idx"
+            ),
+        ),
+    ]
@@ -21,10 +21,37 @@ class Patient(models.Model):
         return f"{self.first_name} {self.last_name}"
 
 class Message(models.Model):
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, null=True, blank=True)
     sender = models.CharField(max_length=10)  # 'patient' or 'bot'
     text = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
-    
+
+    class Meta:
+        indexes = [models.Index(fields=['patient', 'timestamp'])]
+
+class MessageArchiveSegment(models.Model):
+    # A run of old messages for one conversation, moved out of the hot Message table.
+    # `data` is a sequence of independently compressed blocks; `block_index` holds one
+    # [offset, length, message_count, first_timestamp, last_timestamp] entry per block.
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, null=True, blank=True)
+    # Lowest and highest message id; ranges of different segments may overlap
+    first_message_id = models.BigIntegerField()
+    last_message_id = models.BigIntegerField()
+    start_time = models.DateTimeField()
+    end_time = models.DateTimeField()
+    message_count = models.IntegerField()
+    codec = models.CharField(max_length=10)  # 'zstd' or 'gzip'
+    raw_size = models.BigIntegerField()
+    data = models.BinaryField()
+    block_index = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['patient', 'end_time'])]
+
+    def __str__(self):
+        return f"{self.patient} archive {self.start_time} - {self.end_time} ({self.message_count} messages)"
+
 class PatientRequest(models.Model):
     REQUEST_TYPES = [
         ('appointment', 'Appointment Change'),
@@ -39,3 +66,133 @@ class PatientRequest(models.Model):
     def __str__(self):
         return f"{self.patient} - {self.request_type} at {self.timestamp}"
 
+
+class SearchDocument(models.Model):
+    # One indexed Message or PatientRequest. Documents outlive archiving of their message.
+    DOC_TYPES = [
+        ('message', 'Message'),
+        ('request', 'Patient Request'),
+    ]
+
+    doc_type = models.CharField(max_length=10, choices=DOC_TYPES)
+    object_id = models.BigIntegerField()
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, null=True, blank=True)
+    timestamp = models.DateTimeField()
+    length = models.IntegerField()
+
+    class Meta:
+        unique_together = ('doc_type', 'object_id')
+        indexes = [models.Index(fields=['patient', 'timestamp'])]
+
+class SearchPosting(models.Model):
+    term = models.CharField(max_length=64)
+    document = models.ForeignKey(SearchDocument, on_delete=models.CASCADE, related_name='postings')
+    # Copied from the document so a patient's search reads only that patient's postings
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, null=True, blank=True, db_index=False)
+    term_frequency = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['term', 'document']),
+            models.Index(fields=['patient', 'term', 'document']),
+        ]
+
+class MemoryItem(models.Model):
+    # A past message or knowledge-graph fact, embedded for retrieval into the prompt
+    SOURCES = [
+        ('message', 'Message'),
+        ('fact', 'Knowledge Fact'),
+    ]
+
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+    source = models.CharField(max_length=10, choices=SOURCES)
+    source_key = models.CharField(max_length=100)  # message id, or fact name
+    text = models.TextField()
+    vector = models.BinaryField()  # float32, see retrieval.embed
+    token_count = models.IntegerField()
+    timestamp = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('patient', 'source', 'source_key')
+        indexes = [models.Index(fields=['patient', 'updated_at'])]
+
+class Measurement(models.Model):
+    # Append-only vitals, lab results and weight readings
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=50)  # e.g. 'weight', 'systolic_bp', 'hba1c'
+    value = models.FloatField()
+    unit = models.CharField(max_length=20, blank=True)
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=['patient', 'kind', 'timestamp'])]
+
+    def __str__(self):
+        return f"{self.patient} {self.kind} {self.value} {self.unit} at {self.timestamp}"
+
+class MeasurementSummary(models.Model):
+    # Rolling aggregates per patient and kind, refreshed by measurements.refresh_summaries
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=50)
+    unit = models.CharField(max_length=20, blank=True)
+    latest_value = models.FloatField()
+    latest_at = models.DateTimeField()
+    count_7d = models.IntegerField(default=0)
+    min_7d = models.FloatField(null=True, blank=True)
+    max_7d = models.FloatField(null=True, blank=True)
+    mean_7d = models.FloatField(null=True, blank=True)
+    count_30d = models.IntegerField(default=0)
+    min_30d = models.FloatField(null=True, blank=True)
+    max_30d = models.FloatField(null=True, blank=True)
+    mean_30d = models.FloatField(null=True, blank=True)
+    trend_per_day = models.FloatField(null=True, blank=True)  # least-squares slope over 30 days
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('patient', 'kind')
+
+class DailyMessageRollup(models.Model):
+    # Per patient and day message counts, maintained incrementally by analytics.update_rollups
+    day = models.DateField()
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+    patient_messages = models.IntegerField(default=0)
+    bot_messages = models.IntegerField(default=0)
+    off_topic = models.IntegerField(default=0)  # rejected by is_health_related
+    busy_replies = models.IntegerField(default=0)  # turned away by rate limiting
+    llm_errors = models.IntegerField(default=0)  # get_gemini_response failed
+    llm_refusals = models.IntegerField(default=0)  # reply blocked by the content filter
+
+    class Meta:
+        unique_together = ('day', 'patient')
+        indexes = [models.Index(fields=['patient', 'day'])]
+
+class DailyMessageTotal(models.Model):
+    # DailyMessageRollup summed over all patients, so clinic-wide series read one row per day
+    day = models.DateField(unique=True)
+    patient_messages = models.IntegerField(default=0)
+    bot_messages = models.IntegerField(default=0)
+    off_topic = models.IntegerField(default=0)
+    busy_replies = models.IntegerField(default=0)
+    llm_errors = models.IntegerField(default=0)
+    llm_refusals = models.IntegerField(default=0)
+
+class DailyRequestRollup(models.Model):
+    # Per patient, day and request type; clinic-wide series sum the patients
+    day = models.DateField()
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
+    request_type = models.CharField(max_length=20)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'patient', 'request_type')
+        indexes = [models.Index(fields=['patient', 'day'])]
+
+class RollupWatermark(models.Model):
+    # Highest source row id already counted in the rollups, per source table
+    source = models.CharField(max_length=20, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.source} rolled up to id {self.last_id}"
@@ -1,46 +1,164 @@
+import threading
+from contextlib import contextmanager
+
+def get_patient_properties(patient):
+    # Prepare properties dictionary, excluding None values
+    patient_properties = {
+        'date_of_birth': str(patient.date_of_birth) if patient.date_of_birth else None,
+        'phone_number': patient.phone_number,
+        'email': patient.email,
+        'medical_condition': patient.medical_condition,
+        'medication_regimen': patient.medication_regimen,
+        'last_appointment': str(patient.last_appointment) if patient.last_appointment else None,
+        'next_appointment': str(patient.next_appointment) if patient.next_appointment else None,
+        'doctor_name': patient.doctor_name,
+        'lab_tests': patient.lab_tests,
+        'vital_signs': patient.vital_signs,
+        'weight': patient.weight
+    }
+    # Remove keys with None values to prevent overwriting
+    return {k: v for k, v in patient_properties.items() if v is not None}
+
 class Neo4jDriver:
-    def __init__(self, uri, user, password):
+    # Wraps the driver's connection pool. Inside request_scope() every call shares one
+    # session; outside it each call opens its own. Reads and writes are routed with
+    # execute_read / execute_write so a cluster can send reads to followers.
+    def __init__(self, uri, user, password, max_connection_pool_size=50,
+                 connection_acquisition_timeout=10.0, max_connection_lifetime=3600,
+                 liveness_check_timeout=30.0, database=None):
         from neo4j import GraphDatabase
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        self.driver = GraphDatabase.driver(
+            uri,
+            auth=(user, password),
+            max_connection_pool_size=max_connection_pool_size,
+            connection_acquisition_timeout=connection_acquisition_timeout,
+            max_connection_lifetime=max_connection_lifetime,
+            liveness_check_timeout=liveness_check_timeout,
+        )
+        self.database = database
+        self.max_connection_pool_size = max_connection_pool_size
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'sessions_opened': 0,
+            'sessions_reused': 0,
+            'sessions_active': 0,
+            'read_transactions': 0,
+            'write_transactions': 0,
+            'failed_transactions': 0,
+        }
 
     def close(self):
         self.driver.close()
 
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def pool_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['max_connection_pool_size'] = self.max_connection_pool_size
+        return stats
+
+    def _open_session(self):
+        self._count('sessions_opened')
+        self._count('sessions_active')
+        kwargs = {'database': self.database} if self.database else {}
+        return self.driver.session(**kwargs)
+
+    def _close_session(self, session):
+        try:
+            session.close()
+        finally:
+            self._count('sessions_active', -1)
+
+    @contextmanager
+    def request_scope(self):
+        # The shared session is opened lazily, so requests that never touch the graph cost nothing.
+        # Yields this thread's scope stats: the pool counters are shared by every thread, so a
+        # per-request count taken from them would include other requests' sessions.
+        if getattr(self._local, 'in_scope', False):
+            yield self._local.scope_stats
+            return
+        self._local.in_scope = True
+        self._local.session = None
+        self._local.scope_stats = {'sessions_opened': 0, 'sessions_reused': 0}
+        try:
+            yield self._local.scope_stats
+        finally:
+            session = self._local.session
+            self._local.in_scope = False
+            self._local.session = None
+            if session is not None:
+                self._close_session(session)
+
+    @contextmanager
+    def session(self):
+        if getattr(self._local, 'in_scope', False):
+            if self._local.session is None:
+                self._local.session = self._open_session()
+                self._local.scope_stats['sessions_opened'] += 1
+            else:
+                self._local.scope_stats['sessions_reused'] += 1
+                self._count('sessions_reused')
+            yield self._local.session
+            return
+        session = self._open_session()
+        try:
+            yield session
+        finally:
+            self._close_session(session)
+
+    def _execute(self, mode, work):
+        with self.session() as session:
+            try:
+                if mode == 'read':
+                    result = session.execute_read(work)
+                else:
+                    result = session.execute_write(work)
+            except Exception:
+                self._count('failed_transactions')
+                raise
+            self._count(f'{mode}_transactions')
+            return result
+
     def save_patient_data(self, patient):
-        with self.driver.session() as session:
-            # Prepare properties dictionary, excluding None values
-            patient_properties = {
-                'date_of_birth': str(patient.date_of_birth) if patient.date_of_birth else None,
-                'phone_number': patient.phone_number,
-                'email': patient.email,
-                'medical_condition': patient.medical_condition,
-                'medication_regimen': patient.medication_regimen,
-                'last_appointment': str(patient.last_appointment) if patient.last_appointment else None,
-                'next_appointment': str(patient.next_appointment) if patient.next_appointment else None,
-                'doctor_name': patient.doctor_name,
-                'lab_tests': patient.lab_tests,
-                'vital_signs': patient.vital_signs,
-                'weight': patient.weight
-            }
-            # Remove keys with None values to prevent overwriting
-            patient_properties = {k: v for k, v in patient_properties.items() if v is not None}
-            # Build SET clause dynamically
-            set_clause = ', '.join([f'p.{k} = ${k}' for k in patient_properties.keys()])
-
-            query = f"""
-                MERGE (p:Patient {{name: $patient_name}})
-                SET {set_clause}
-            """
-            params = {'patient_name': f"{patient.first_name} {patient.last_name}"}
-            params.update(patient_properties)
+        patient_properties = get_patient_properties(patient)
+        # Build SET clause dynamically
+        set_clause = ', '.join([f'p.{k} = ${k}' for k in patient_properties.keys()])
+
+        query = f"""
+            MERGE (p:Patient {{name: $patient_name}})
+            SET {set_clause}
+        """
+        params = {'patient_name': f"{patient.first_name} {patient.last_name}"}
+        params.update(patient_properties)
 
-            session.run(query, **params)
+        self._execute('write', lambda tx: tx.run(query, **params).consume())
+
+    def save_patients_batch(self, patients):
+        # One UNWIND write for a whole batch of patients instead of a round trip each
+        rows = [
+            {'name': f"{patient.first_name} {patient.last_name}", 'props': get_patient_properties(patient)}
+            for patient in patients
+        ]
+        if not rows:
+            return
+        self._execute('write', lambda tx: tx.run(
+            """
+            UNWIND $rows AS row
+            MERGE (p:Patient {name: row.name})
+            SET p += row.props
+            """,
+            rows=rows
+        ).consume())
 
     def save_entities(self, patient_name, entities):
-        with self.driver.session() as session:
+        def work(tx):
             for key, value in entities.items():
                 if value:
-                    session.run(
+                    tx.run(
                         """
                         MERGE (p:Patient {{name: $patient_name}})
                         MERGE (e:Entity {{name: $value}})
@@ -48,44 +166,93 @@ class Neo4jDriver:
                         """.format(key.upper()),
                         patient_name=patient_name,
                         value=value
-                    )
+                    ).consume()
+
+        self._execute('write', work)
+
+    def save_entities_batch(self, rows):
+        # rows: (patient_name, entities) pairs written in one transaction. Relationship
+        # types can't be parameters, so there is one UNWIND per entity type.
+        by_type = {}
+        for patient_name, entities in rows:
+            for key, value in entities.items():
+                # Keys become part of the query text, so only plain identifiers are accepted
+                if value and key.isidentifier():
+                    by_type.setdefault(key.upper(), []).append({'patient': patient_name, 'value': value})
+        if not by_type:
+            return
+
+        def work(tx):
+            for relationship, items in by_type.items():
+                tx.run(
+                    """
+                    UNWIND $items AS item
+                    MERGE (p:Patient {{name: item.patient}})
+                    MERGE (e:Entity {{name: item.value}})
+                    MERGE (p)-[:HAS_{}]->(e)
+                    """.format(relationship),
+                    items=items
+                ).consume()
+
+        self._execute('write', work)
 
     def get_patient_knowledge(self, patient_name):
-        with self.driver.session() as session:
+        def work(tx):
             # Get patient properties
-            result_props = session.run(
+            record_props = tx.run(
                 """
                 MATCH (p:Patient {name: $patient_name})
                 RETURN properties(p) as patient_props
                 """,
                 patient_name=patient_name
-            )
-            patient_props = {}
-            record_props = result_props.single()
-            if record_props:
-                patient_props = record_props["patient_props"]
-
-            # Get related entities
-            result_entities = session.run(
-                """
-                MATCH (p:Patient {name: $patient_name})-[r]->(e)
-                RETURN type(r) as relationship, e.name as entity
-                """,
-                patient_name=patient_name
-            )
-            entities = {}
-            for record in result_entities:
-                relationship = record["relationship"].replace('HAS_', '').lower()
-                entity = record["entity"]
-                # Handle multiple entities per relationship type
-                if relationship in entities:
-                    if isinstance(entities[relationship], list):
-                        entities[relationship].append(entity)
-                    else:
-                        entities[relationship] = [entities[relationship], entity]
-                else:
-                    entities[relationship] = entity
+            ).single()
+            return record_props, _related_entities(tx, patient_name)
+
+        record_props, entities = self._execute('read', work)
+        patient_props = {}
+        if record_props:
+            patient_props = record_props["patient_props"]
+
+        # Combine properties and entities
+        knowledge = {**patient_props, **entities}
+        return knowledge
+
+    def get_patient_entities(self, patient_name):
+        # Only the extracted entities (HAS_* relationships), keyed like extract_entities output
+        return self._execute('read', lambda tx: _related_entities(tx, patient_name))
+
+
+def _related_entities(tx, patient_name):
+    records_entities = list(tx.run(
+        """
+        MATCH (p:Patient {name: $patient_name})-[r]->(e)
+        RETURN type(r) as relationship, e.name as entity
+        """,
+        patient_name=patient_name
+    ))
+    entities = {}
+    for record in records_entities:
+        relationship = record["relationship"].replace('HAS_', '').lower()
+        entity = record["entity"]
+        # Handle multiple entities per relationship type
+        if relationship in entities:
+            if isinstance(entities[relationship], list):
+                entities[relationship].append(entity)
+            else:
+                entities[relationship] = [entities[relationship], entity]
+        else:
+            entities[relationship] = entity
+    return entities
+
+
+_graph_driver = None
+_graph_driver_lock = threading.Lock()
 
-            # Combine properties and entities
-            knowledge = {**patient_props, **entities}
-            return knowledge
+def get_graph_driver():
+    # Process-wide driver (and connection pool) built from settings.NEO4J
+    global _graph_driver
+    with _graph_driver_lock:
+        if _graph_driver is None:
+            from django.conf import settings
+            _graph_driver = Neo4jDriver(**settings.NEO4J)
+        return _graph_driver
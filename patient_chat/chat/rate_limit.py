@@ -0,0 +1,194 @@
+# Admission control for LLM calls.
+#
+# Two layers sit in front of every ChatGoogleGenerativeAI request:
+#   - a per-patient token bucket that limits how fast one patient can trigger turns
+#   - a global concurrency semaphore with a bounded wait queue, where interactive
+#     replies always go ahead of background work (entity extraction, summaries)
+# All state lives in Django's cache so every worker sharing the cache sees the same limits.
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+DEFAULT_ADMISSION = {
+    'PATIENT_BUCKET_CAPACITY': 5,
+    'PATIENT_REFILL_PER_SECOND': 0.2,
+    'MAX_CONCURRENCY': 8,
+    'RESERVED_INTERACTIVE_SLOTS': 2,
+    'MAX_QUEUE': 16,
+    'INTERACTIVE_WAIT_SECONDS': 10.0,
+    'BACKGROUND_WAIT_SECONDS': 2.0,
+    'POLL_INTERVAL_SECONDS': 0.05,
+    'SLOT_TTL_SECONDS': 120,
+}
+
+# One cache entry holds every slot lease and waiter as {id: (priority, expires_at)}.
+# Each entry carries its own expiry, so leases left by a crashed worker lapse after
+# SLOT_TTL_SECONDS without resetting the ones still held.
+STATE_KEY = 'llm_admission:state'
+
+
+class RateLimited(Exception):
+    pass
+
+
+def get_config():
+    config = dict(DEFAULT_ADMISSION)
+    config.update(getattr(settings, 'LLM_ADMISSION', {}))
+    return config
+
+
+@contextmanager
+def _cache_lock(key, timeout=2.0, poll_interval=0.005):
+    # cache.add is atomic on every backend, so it doubles as a short mutex
+    lock_key = f'{key}:lock'
+    deadline = time.monotonic() + timeout
+    while not cache.add(lock_key, 1, timeout=int(timeout) + 1):
+        if time.monotonic() > deadline:
+            raise RateLimited(f"Timed out waiting for lock {lock_key}")
+        time.sleep(poll_interval)
+    try:
+        yield
+    finally:
+        cache.delete(lock_key)
+
+
+# Take `cost` tokens from the patient's bucket; returns False when the bucket is empty
+def consume_patient_token(patient_id, cost=1, now=None):
+    config = get_config()
+    capacity = config['PATIENT_BUCKET_CAPACITY']
+    refill_rate = config['PATIENT_REFILL_PER_SECOND']
+    key = f'llm_admission:bucket:{patient_id}'
+    # Idle buckets refill completely, so they can expire once that has happened
+    ttl = int(capacity / refill_rate) + 1 if refill_rate > 0 else None
+
+    with _cache_lock(key):
+        now = time.time() if now is None else now
+        tokens, updated_at = cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * refill_rate)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        cache.set(key, (tokens, now), timeout=ttl)
+    return allowed
+
+
+def _load_state(now):
+    state = cache.get(STATE_KEY) or {'slots': {}, 'waiting': {}}
+    for entries in state.values():
+        for entry_id in [entry_id for entry_id, (_priority, expires_at) in entries.items() if expires_at <= now]:
+            del entries[entry_id]
+    return state
+
+
+def _update_state(change):
+    # Applies change(state, now) under the admission lock and stores the result
+    with _cache_lock(STATE_KEY):
+        now = time.time()
+        state = _load_state(now)
+        result = change(state, now)
+        cache.set(STATE_KEY, state, timeout=None)
+    return result
+
+
+def _take_slot(state, now, priority, lease_id, config):
+    limit = config['MAX_CONCURRENCY']
+    if priority == BACKGROUND:
+        # Background work never takes the slots reserved for interactive replies,
+        # and never jumps ahead of an interactive request that is already waiting
+        limit -= config['RESERVED_INTERACTIVE_SLOTS']
+        if any(waiting == INTERACTIVE for waiting, _expires_at in state['waiting'].values()):
+            return False
+    if len(state['slots']) >= limit:
+        return False
+    state['slots'][lease_id] = (priority, now + config['SLOT_TTL_SECONDS'])
+    return True
+
+
+def try_acquire_slot(priority=INTERACTIVE):
+    # A slot lease id if one is free right now, otherwise None (never waits or queues)
+    config = get_config()
+    lease_id = uuid.uuid4().hex
+    taken = _update_state(lambda state, now: _take_slot(state, now, priority, lease_id, config))
+    return lease_id if taken else None
+
+
+def acquire_slot(priority=INTERACTIVE, max_wait=None):
+    # Waits in the bounded queue for a slot and returns its lease id. Raises
+    # RateLimited straight away when the queue is full, once the wait runs out, or
+    # when a background waiter is displaced by an interactive call.
+    config = get_config()
+    lease_id = uuid.uuid4().hex
+
+    def take_or_queue(state, now):
+        if _take_slot(state, now, priority, lease_id, config):
+            return True
+        if len(state['waiting']) >= config['MAX_QUEUE']:
+            # A full queue still admits interactive calls by displacing background waiters
+            displaced = next(
+                (waiter for waiter, (waiting, _expires_at) in state['waiting'].items() if waiting == BACKGROUND),
+                None,
+            ) if priority == INTERACTIVE else None
+            if displaced is None:
+                raise RateLimited("LLM wait queue is full")
+            del state['waiting'][displaced]
+        state['waiting'][lease_id] = (priority, now + config['SLOT_TTL_SECONDS'])
+        return False
+
+    if _update_state(take_or_queue):
+        return lease_id
+
+    def take_from_queue(state, now):
+        if lease_id not in state['waiting']:
+            raise RateLimited("Displaced from the LLM wait queue")
+        if _take_slot(state, now, priority, lease_id, config):
+            del state['waiting'][lease_id]
+            return True
+        return False
+
+    wait_seconds = (
+        config['INTERACTIVE_WAIT_SECONDS'] if priority == INTERACTIVE else config['BACKGROUND_WAIT_SECONDS']
+    )
+    if max_wait is not None:
+        wait_seconds = min(wait_seconds, max_wait)
+    deadline = time.monotonic() + wait_seconds
+    try:
+        while time.monotonic() < deadline:
+            time.sleep(config['POLL_INTERVAL_SECONDS'])
+            if _update_state(take_from_queue):
+                return lease_id
+    except BaseException:
+        _update_state(lambda state, now: state['waiting'].pop(lease_id, None))
+        raise
+    _update_state(lambda state, now: state['waiting'].pop(lease_id, None))
+    raise RateLimited("Timed out waiting for an LLM slot")
+
+
+def release_slot(lease_id):
+    _update_state(lambda state, now: state['slots'].pop(lease_id, None))
+
+
+# Hold one of the global LLM concurrency slots for the duration of the block
+@contextmanager
+def llm_slot(priority=INTERACTIVE):
+    lease_id = acquire_slot(priority)
+    try:
+        yield
+    finally:
+        release_slot(lease_id)
+
+
+def admission_stats():
+    state = _load_state(time.time())
+    return {
+        'in_flight': len(state['slots']),
+        'waiting': len(state['waiting']),
+        'waiting_interactive': sum(
+            1 for priority, _expires_at in state['waiting'].values() if priority == INTERACTIVE
+        ),
+    }
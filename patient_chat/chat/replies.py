@@ -0,0 +1,12 @@
+# Canned bot replies. Analytics counts them in stored messages, so changing a string
+# here stops older messages with the previous wording from being recognised.
+
+# Message rejected by is_health_related
+OFF_TOPIC_REPLY = "I'm sorry, but I can only assist with health-related questions."
+
+# Fast reply used when admission control turns a request away
+BUSY_REPLY = "I'm getting a lot of messages right now. Please try again in a moment."
+
+# get_gemini_response fallbacks: the call failed, or the reply hit the content filter
+LLM_ERROR_REPLY = "Sorry, I'm having trouble responding right now."
+LLM_REFUSAL_REPLY = "I'm sorry, but I can't assist with that request."
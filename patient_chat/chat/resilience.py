@@ -0,0 +1,330 @@
+# Resilience wrapper for LLM calls.
+#
+# call_with_resilience() runs a provider call under a hard deadline, retries
+# idempotent calls with jittered exponential backoff, can hedge a second request
+# once the first has been slower than the recent p95, and fails fast through a
+# circuit breaker while the provider keeps failing. Every outcome is counted.
+#
+# With admission set, every underlying request (including hedges, and calls still
+# running after their deadline) holds its own rate_limit slot until it returns, so
+# LLM_MAX_CONCURRENCY bounds what is really in flight. Calls that outlive their
+# deadline keep a pool worker busy; once every worker is taken, new calls fail fast.
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from .rate_limit import RateLimited, acquire_slot, release_slot, try_acquire_slot
+
+DEFAULT_RESILIENCE = {
+    'DEADLINE_SECONDS': 20.0,
+    'RETRIES': 2,
+    'BACKOFF_BASE_SECONDS': 0.5,
+    'BACKOFF_CAP_SECONDS': 4.0,
+    'HEDGE': False,
+    'HEDGE_MIN_SAMPLES': 20,
+    'BREAKER_FAILURE_THRESHOLD': 5,
+    'BREAKER_RESET_SECONDS': 30.0,
+    'MAX_WORKERS': 16,
+    # Client-side timeout for each underlying request; bounds how long an abandoned
+    # call holds its slot and pool worker (keep it below SLOT_TTL_SECONDS)
+    'CALL_TIMEOUT_SECONDS': 60.0,
+}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class PoolSaturated(RateLimited):
+    # Every pool worker is busy, typically with calls abandoned at their deadline
+    pass
+
+
+def get_config():
+    config = dict(DEFAULT_RESILIENCE)
+    config.update(getattr(settings, 'LLM_RESILIENCE', {}))
+    return config
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return False
+                # Let a single trial call through to probe the provider
+                self.state = self.HALF_OPEN
+                return True
+            if self.state == self.HALF_OPEN:
+                return False
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def release_probe(self):
+        # The probe never reached the provider: back to OPEN with the old opened_at, so the
+        # next call past the reset timeout probes again
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class CallMetrics:
+    def __init__(self, window=200):
+        self.counts = defaultdict(int)
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    def incr(self, name, outcome):
+        with self.lock:
+            self.counts[(name, outcome)] += 1
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.latencies[name].append(seconds)
+
+    def p95(self, name, min_samples):
+        with self.lock:
+            samples = sorted(self.latencies[name])
+        if len(samples) < min_samples:
+            return None
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+        result = defaultdict(dict)
+        for (name, outcome), count in counts.items():
+            result[name][outcome] = count
+        return dict(result)
+
+
+metrics = CallMetrics()
+_breakers = {}
+_breakers_lock = threading.Lock()
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+_running = 0
+
+
+def get_breaker(name):
+    with _breakers_lock:
+        if name not in _breakers:
+            config = get_config()
+            _breakers[name] = CircuitBreaker(
+                config['BREAKER_FAILURE_THRESHOLD'], config['BREAKER_RESET_SECONDS']
+            )
+        return _breakers[name]
+
+
+def _get_executor():
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None:
+            _executor_workers = get_config()['MAX_WORKERS']
+            _executor = ThreadPoolExecutor(max_workers=_executor_workers, thread_name_prefix='llm-call')
+        return _executor
+
+
+def ensure_pool_size(max_workers):
+    # Grows the shared pool for callers running more concurrent calls than MAX_WORKERS
+    # (e.g. a backfill with many workers); calls already running finish on the old pool
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is not None and _executor_workers >= max_workers:
+            return
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor_workers = max(max_workers, get_config()['MAX_WORKERS'])
+        _executor = ThreadPoolExecutor(max_workers=_executor_workers, thread_name_prefix='llm-call')
+
+
+def pool_stats():
+    with _executor_lock:
+        return {'running': _running, 'max_workers': _executor_workers or get_config()['MAX_WORKERS']}
+
+
+def _backoff(attempt, config):
+    # Full jitter: uniform over [0, min(cap, base * 2^attempt)]
+    ceiling = min(config['BACKOFF_CAP_SECONDS'], config['BACKOFF_BASE_SECONDS'] * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+def _timed(name, fn):
+    started = time.monotonic()
+    result = fn()
+    metrics.observe(name, time.monotonic() - started)
+    return result
+
+
+def _run(name, fn, lease_id):
+    global _running
+    try:
+        return _timed(name, fn)
+    finally:
+        with _executor_lock:
+            _running -= 1
+        if lease_id is not None:
+            release_slot(lease_id)
+
+
+def _submit(name, fn, admission, deadline_at, hedge=False):
+    # Takes a slot (hedges only take a free one, never wait) and a pool worker, both
+    # held until fn returns. Returns None when a hedge can't get either.
+    global _running
+    executor = _get_executor()
+    lease_id = None
+    if admission is not None:
+        if hedge:
+            lease_id = try_acquire_slot(admission)
+            if lease_id is None:
+                return None
+        else:
+            lease_id = acquire_slot(admission, max_wait=max(0.0, deadline_at - time.monotonic()))
+    with _executor_lock:
+        saturated = _running >= _executor_workers
+        if not saturated:
+            _running += 1
+    if saturated:
+        if lease_id is not None:
+            release_slot(lease_id)
+        if hedge:
+            return None
+        raise PoolSaturated(f"All {_executor_workers} LLM call workers are busy")
+    return executor.submit(_run, name, fn, lease_id)
+
+
+def _attempt(name, fn, deadline_at, hedge_after, admission):
+    pending = {_submit(name, fn, admission, deadline_at)}
+    original = None
+    hedged = False
+    first_error = None
+
+    while pending:
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            break
+        timeout = remaining
+        if hedge_after is not None and not hedged:
+            timeout = min(remaining, hedge_after)
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            error = future.exception()
+            if error is None:
+                if hedged:
+                    metrics.incr(name, 'hedge_won' if future is not original else 'hedge_lost')
+                # The slower hedge keeps running until it returns
+                for _loser in pending:
+                    metrics.incr(name, 'abandoned')
+                return future.result()
+            first_error = first_error or error
+
+        if not done and hedge_after is not None and not hedged:
+            hedged = True
+            hedge_future = _submit(name, fn, admission, deadline_at, hedge=True)
+            if hedge_future is None:
+                metrics.incr(name, 'hedge_skipped')
+            else:
+                original = next(iter(pending))
+                pending.add(hedge_future)
+                metrics.incr(name, 'hedged')
+        elif not pending and first_error is not None:
+            raise first_error
+
+    # Calls that overran the deadline keep their slot and worker until they return
+    for future in pending:
+        metrics.incr(name, 'abandoned')
+    raise DeadlineExceeded(f"{name} did not finish within its deadline")
+
+
+def call_with_resilience(name, fn, idempotent=True, deadline=None, retries=None, hedge=None,
+                         breaker=None, admission=None):
+    # admission: rate_limit priority each underlying request takes a slot with, or None
+    config = get_config()
+    deadline = config['DEADLINE_SECONDS'] if deadline is None else deadline
+    retries = config['RETRIES'] if retries is None else retries
+    hedge = config['HEDGE'] if hedge is None else hedge
+    breaker = get_breaker(name) if breaker is None else breaker
+
+    if not idempotent:
+        # Non-idempotent calls are never repeated, neither by retry nor by hedging
+        retries = 0
+        hedge = False
+
+    metrics.incr(name, 'calls')
+    if not breaker.allow():
+        metrics.incr(name, 'short_circuited')
+        raise CircuitOpen(f"Circuit for {name} is open")
+    # While half-open every other call is refused, so this call is the probe
+    probing = breaker.state == CircuitBreaker.HALF_OPEN
+
+    deadline_at = time.monotonic() + deadline
+    last_error = None
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = _backoff(attempt - 1, config)
+            if time.monotonic() + delay >= deadline_at:
+                break
+            time.sleep(delay)
+            metrics.incr(name, 'retries')
+
+        hedge_after = metrics.p95(name, config['HEDGE_MIN_SAMPLES']) if hedge else None
+        try:
+            result = _attempt(name, fn, deadline_at, hedge_after, admission)
+        except RateLimited:
+            # Local overload, not a provider failure: no retry, and the breaker is untouched
+            # except that a rejected probe must not leave it half-open for good
+            metrics.incr(name, 'rejected')
+            if probing:
+                breaker.release_probe()
+            raise
+        except DeadlineExceeded as error:
+            metrics.incr(name, 'timeouts')
+            last_error = error
+            break
+        except Exception as error:
+            metrics.incr(name, 'errors')
+            last_error = error
+            continue
+
+        metrics.incr(name, 'successes')
+        breaker.record_success()
+        return result
+
+    metrics.incr(name, 'failures')
+    breaker.record_failure()
+    raise last_error or DeadlineExceeded(f"{name} ran out of time before retrying")
@@ -0,0 +1,309 @@
+# Retrieval of relevant patient history for the prompt.
+#
+# Past messages and knowledge-graph facts are embedded as they are written into
+# MemoryItem rows. Vectors are signed hashed bag-of-words, so no model download or
+# network call is needed. At prompt time the current message is
+# embedded and the most similar items are picked until the token budget is spent.
+# Each worker keeps a per-patient NumPy matrix in memory. Writes bump the patient's
+# version key, and the matrix then loads only the changed rows; deletions bump the
+# generation key, which makes every worker rebuild the matrix from scratch.
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import MemoryItem
+from .search import tokenize
+
+DIMENSIONS = 512
+# Items less similar than this to the current message are never added to the prompt
+MIN_SIMILARITY = 0.15
+# Hashed vectors collide, so the top CANDIDATE_FACTOR * k by score are checked for a
+# real shared term with the message before they can be picked
+CANDIDATE_FACTOR = 5
+# Patients whose matrices each worker keeps in memory
+MAX_CACHED_PATIENTS = 32
+# Random-hyperplane LSH tables, used once a patient has more items than
+# settings.RETRIEVAL_ANN_THRESHOLD (off by default: brute force is exact and fast enough
+# for typical histories, while LSH recall drops on short, sparse messages)
+LSH_TABLES = 8
+LSH_BITS = 8
+LSH_SEED = 7
+
+
+def count_tokens(text):
+    # Same whitespace approximation generate_prompt has always used for its budget
+    return len(text.split())
+
+
+def _bucket(feature):
+    return zlib.crc32(feature.encode('utf-8')) % DIMENSIONS
+
+
+def embed(text):
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    for feature in tokenize(text):
+        # Signed hashing keeps collisions from always adding up
+        sign = 1.0 if zlib.adler32(feature.encode('utf-8')) & 1 else -1.0
+        vector[_bucket(feature)] += sign
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+def _bump(key):
+    if not cache.add(key, 1, timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+
+def _bump_version(patient_id):
+    _bump(f'retrieval:version:{patient_id}')
+
+
+def forget_patient(patient_id):
+    # Deletes every item of the patient; cached indexes are dropped, not patched
+    MemoryItem.objects.filter(patient_id=patient_id).delete()
+    _bump(f'retrieval:generation:{patient_id}')
+    _bump_version(patient_id)
+
+
+# `text` is what goes into the prompt; `embed_text` (default: text) is what gets matched
+def remember(patient_id, source, source_key, text, timestamp=None, embed_text=None):
+    if not text:
+        return
+    MemoryItem.objects.update_or_create(
+        patient_id=patient_id,
+        source=source,
+        source_key=str(source_key)[:100],
+        defaults={
+            'text': text,
+            'vector': embed(embed_text or text).tobytes(),
+            'token_count': count_tokens(text),
+            'timestamp': timestamp or timezone.now(),
+        },
+    )
+    _bump_version(patient_id)
+
+
+def remember_many(patient_id, rows, batch_size=1000):
+    # Bulk insert for rebuilds: rows are (source, source_key, text, timestamp, embed_text)
+    # and must not be indexed yet
+    batch = []
+    for source, source_key, text, timestamp, embed_text in rows:
+        batch.append(MemoryItem(
+            patient_id=patient_id,
+            source=source,
+            source_key=str(source_key)[:100],
+            text=text,
+            vector=embed(embed_text or text).tobytes(),
+            token_count=count_tokens(text),
+            timestamp=timestamp,
+        ))
+        if len(batch) >= batch_size:
+            MemoryItem.objects.bulk_create(batch)
+            batch = []
+    MemoryItem.objects.bulk_create(batch)
+    _bump_version(patient_id)
+
+
+def message_memory_text(sender, text):
+    speaker = 'Patient' if sender == 'patient' else 'Assistant'
+    return f"{speaker}: {text}"
+
+
+def remember_message(message):
+    if message.patient_id is None:
+        return
+    remember(
+        message.patient_id, 'message', message.id,
+        message_memory_text(message.sender, message.text), message.timestamp, embed_text=message.text,
+    )
+
+
+def remember_facts(patient_id, facts):
+    # facts: {name: value}. Only facts whose text changed are re-embedded.
+    existing = dict(
+        MemoryItem.objects.filter(patient_id=patient_id, source='fact').values_list('source_key', 'text')
+    )
+    changed = False
+    for name, value in facts.items():
+        if value is None or value == '' or value == []:
+            continue
+        if isinstance(value, list):
+            value = ', '.join(str(v) for v in value if v is not None)
+        text = f"{name.replace('_', ' ').title()}: {value}"
+        if existing.get(name[:100]) == text:
+            continue
+        MemoryItem.objects.update_or_create(
+            patient_id=patient_id,
+            source='fact',
+            source_key=name[:100],
+            defaults={
+                'text': text,
+                'vector': embed(text).tobytes(),
+                'token_count': count_tokens(text),
+                'timestamp': timezone.now(),
+            },
+        )
+        changed = True
+    if changed:
+        _bump_version(patient_id)
+
+
+def remember_entities(patient_id, entities):
+    # Extracted entities accumulate like the graph's HAS_* relationships, one item per value;
+    # a list (as the graph returns several entities of one type) gives one item per element
+    for key, values in entities.items():
+        for value in values if isinstance(values, list) else [values]:
+            if value:
+                remember(patient_id, 'fact', f"{key}:{value}", f"{key.replace('_', ' ').title()}: {value}")
+
+
+ITEM_FIELDS = ('id', 'source', 'source_key', 'text', 'vector', 'token_count', 'timestamp', 'updated_at')
+
+
+class PatientVectorIndex:
+    def __init__(self, version, generation=0):
+        self.version = version
+        self.generation = generation
+        self.loaded_until = None
+        self.items = []
+        self.positions = {}
+        self.matrix = np.zeros((0, DIMENSIONS), dtype=np.float32)
+        self.planes = None
+        self.buckets = None
+
+    def apply(self, rows):
+        # Add new items and replace updated ones; vectors live only in the matrix
+        appended = []
+        vectors = []
+        for row in rows:
+            vector = np.frombuffer(bytes(row.pop('vector')), dtype=np.float32)
+            position = self.positions.get(row['id'])
+            if position is None:
+                self.positions[row['id']] = len(self.items) + len(appended)
+                appended.append(row)
+                vectors.append(vector)
+            else:
+                self.items[position] = row
+                self.matrix[position] = vector
+            if self.loaded_until is None or row['updated_at'] > self.loaded_until:
+                self.loaded_until = row['updated_at']
+        if appended:
+            self.items.extend(appended)
+            self.matrix = np.vstack([self.matrix, np.vstack(vectors)])
+
+        ann_threshold = getattr(settings, 'RETRIEVAL_ANN_THRESHOLD', None)
+        if rows and ann_threshold is not None and len(self.items) > ann_threshold:
+            self._build_lsh()
+
+    def _build_lsh(self):
+        if self.planes is None:
+            rng = np.random.default_rng(LSH_SEED)
+            self.planes = rng.standard_normal((DIMENSIONS, LSH_TABLES * LSH_BITS)).astype(np.float32)
+        self.buckets = []
+        for signatures in self._signatures(self.matrix):
+            order = np.argsort(signatures, kind='stable')
+            keys, starts = np.unique(signatures[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            self.buckets.append({int(key): order[start:end] for key, start, end in zip(keys, starts, ends)})
+
+    def _signatures(self, vectors):
+        # One integer signature per table and vector: shape (LSH_TABLES, len(vectors))
+        bits = ((vectors @ self.planes) > 0).reshape(len(vectors), LSH_TABLES, LSH_BITS)
+        return (bits.astype(np.int64) @ (1 << np.arange(LSH_BITS, dtype=np.int64))).T
+
+    def _candidates(self, query, k):
+        found = []
+        for table, signature in enumerate(self._signatures(query[None, :])[:, 0]):
+            bucket = self.buckets[table].get(int(signature))
+            if bucket is not None:
+                found.append(bucket)
+        candidates = np.unique(np.concatenate(found)) if found else np.array([], dtype=np.int64)
+        if len(candidates) < k:
+            return None
+        return candidates
+
+    def top(self, query, k):
+        if not self.items:
+            return []
+        candidates = self._candidates(query, k) if self.buckets is not None else None
+        if candidates is None:
+            scores = self.matrix @ query
+            indices = np.arange(len(scores))
+        else:
+            scores = self.matrix[candidates] @ query
+            indices = candidates
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(self.items[int(indices[i])], float(scores[i])) for i in best]
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _load(index, patient_id):
+    rows = MemoryItem.objects.filter(patient_id=patient_id)
+    if index.loaded_until is not None:
+        rows = rows.filter(updated_at__gte=index.loaded_until)
+    index.apply(list(rows.order_by('id').values(*ITEM_FIELDS)))
+
+
+def get_index(patient_id):
+    # Loads the patient's items once, then only rows written since the last refresh.
+    # A new generation, or rows deleted without one, means a full reload.
+    version = cache.get(f'retrieval:version:{patient_id}', 0)
+    generation = cache.get(f'retrieval:generation:{patient_id}', 0)
+    with _indexes_lock:
+        index = _indexes.get(patient_id)
+        if index is None or index.generation != generation:
+            index = _indexes[patient_id] = PatientVectorIndex(version=None, generation=generation)
+            while len(_indexes) > MAX_CACHED_PATIENTS:
+                _indexes.popitem(last=False)
+        _indexes.move_to_end(patient_id)
+        if index.version == version:
+            return index
+
+        _load(index, patient_id)
+        if index.loaded_until is not None and len(index.items) != MemoryItem.objects.filter(
+                patient_id=patient_id).count():
+            index = _indexes[patient_id] = PatientVectorIndex(version=None, generation=generation)
+            _load(index, patient_id)
+        index.version = version
+        return index
+
+
+def has_memory(patient_id):
+    return bool(get_index(patient_id).items)
+
+
+def retrieve(patient_id, query_text, token_budget, k=20, exclude_message_ids=()):
+    # Most relevant items first, as many as fit within token_budget
+    index = get_index(patient_id)
+    query_terms = set(tokenize(query_text))
+    excluded = {str(message_id) for message_id in exclude_message_ids}
+    selected = []
+    used = 0
+    for item, score in index.top(embed(query_text), k * CANDIDATE_FACTOR):
+        if score < MIN_SIMILARITY or len(selected) >= k:
+            break
+        if item['source'] == 'message' and item['source_key'] in excluded:
+            continue
+        if used + item['token_count'] > token_budget:
+            continue
+        if query_terms.isdisjoint(tokenize(item['text'])):
+            # Similar only through hash collisions
+            continue
+        selected.append(item)
+        used += item['token_count']
+    return selected
@@ -0,0 +1,204 @@
+# Full-text search over chat messages and patient requests.
+#
+# A small inverted index kept in the database: one SearchDocument per indexed row
+# and one SearchPosting per (term, document). Rows are indexed as they are written
+# (see signals.py), and queries are ranked with BM25 and can be narrowed to a
+# patient and a date range.
+import html
+import math
+import re
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Avg, Case, Count, F, FloatField, Sum, Value, When
+from django.db.models.functions import Cast
+
+from .archive import find_archived_message
+from .models import Message, PatientRequest, SearchDocument, SearchPosting
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'i', 'if', 'in',
+    'is', 'it', 'me', 'my', 'of', 'on', 'or', 'so', 'that', 'the', 'this', 'to', 'was',
+    'we', 'what', 'with', 'you', 'your',
+}
+MAX_TERM_LENGTH = 64
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+STATS_CACHE_KEY = 'search:stats'
+STATS_CACHE_SECONDS = 300
+DF_CACHE_PREFIX = 'search:df:'
+
+
+def tokenize(text):
+    return [
+        token[:MAX_TERM_LENGTH]
+        for token in TOKEN_PATTERN.findall(text.lower())
+        if token not in STOPWORDS
+    ]
+
+
+def build_document(doc_type, object_id, patient_id, timestamp, text):
+    terms = Counter(tokenize(text))
+    document = SearchDocument(
+        doc_type=doc_type,
+        object_id=object_id,
+        patient_id=patient_id,
+        timestamp=timestamp,
+        length=sum(terms.values()),
+    )
+    return document, terms
+
+
+def index_documents(rows, replace=True):
+    # rows: (doc_type, object_id, patient_id, timestamp, text) tuples of a single doc_type,
+    # indexed in one batch. Re-indexing a row replaces its previous postings unless
+    # replace=False (used by full rebuilds, which start from an empty index).
+    built = [build_document(*row) for row in rows]
+    if not built:
+        return 0
+    with transaction.atomic():
+        if replace:
+            SearchDocument.objects.filter(
+                doc_type=built[0][0].doc_type,
+                object_id__in=[document.object_id for document, _terms in built],
+            ).delete()
+        documents = SearchDocument.objects.bulk_create([document for document, _terms in built])
+        if any(document.pk is None for document in documents):
+            # Backends that don't return ids from bulk_create (MySQL) need a lookup
+            ids = dict(SearchDocument.objects.filter(
+                doc_type=built[0][0].doc_type,
+                object_id__in=[document.object_id for document in documents],
+            ).values_list('object_id', 'id'))
+            for document in documents:
+                document.pk = ids[document.object_id]
+        SearchPosting.objects.bulk_create([
+            SearchPosting(
+                term=term, document_id=document.pk, patient_id=document.patient_id, term_frequency=frequency,
+            )
+            for document, (_document, terms) in zip(documents, built)
+            for term, frequency in terms.items()
+        ], batch_size=1000)
+    return len(documents)
+
+
+def index_message(message):
+    index_documents([('message', message.id, message.patient_id, message.timestamp, message.text)])
+
+
+def index_patient_request(patient_request):
+    index_documents([(
+        'request', patient_request.id, patient_request.patient_id,
+        patient_request.timestamp, patient_request.details,
+    )])
+
+
+def index_stats():
+    stats = cache.get(STATS_CACHE_KEY)
+    if stats is None:
+        aggregate = SearchDocument.objects.aggregate(count=Count('id'), avg_length=Avg('length'))
+        stats = (aggregate['count'], aggregate['avg_length'] or 0.0)
+        cache.set(STATS_CACHE_KEY, stats, STATS_CACHE_SECONDS)
+    return stats
+
+
+def term_document_frequencies(terms, total_documents):
+    # Counting a common term's postings is the slowest part of a patient's search, and the
+    # counts barely move between queries. They are cached under the cached document count,
+    # so they refresh along with index_stats() (and right after a rebuild).
+    keys = {f'{DF_CACHE_PREFIX}{total_documents}:{term}': term for term in terms}
+    frequencies = {keys[key]: df for key, df in cache.get_many(list(keys)).items()}
+    missing = [term for term in terms if term not in frequencies]
+    if missing:
+        counted = dict.fromkeys(missing, 0)
+        counted.update(
+            SearchPosting.objects.filter(term__in=missing)
+            .values_list('term').annotate(df=Count('id')).values_list('term', 'df')
+        )
+        cache.set_many(
+            {f'{DF_CACHE_PREFIX}{total_documents}:{term}': df for term, df in counted.items()}, STATS_CACHE_SECONDS
+        )
+        frequencies.update(counted)
+    return frequencies
+
+
+def search(query, patient=None, start=None, end=None, limit=20):
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return []
+
+    total_documents, avg_length = index_stats()
+    if not total_documents:
+        return []
+
+    document_frequencies = term_document_frequencies(terms, total_documents)
+    postings = SearchPosting.objects.filter(term__in=terms)
+    if patient is not None:
+        postings = postings.filter(patient=patient)
+    if start is not None:
+        postings = postings.filter(document__timestamp__gte=start)
+    if end is not None:
+        postings = postings.filter(document__timestamp__lte=end)
+
+    # Scored in the database: one row per matching document comes back, and only the top `limit`
+    frequency = Cast(F('term_frequency'), FloatField())
+    if avg_length:
+        norm = Value(K1 * (1 - B)) + Value(K1 * B / avg_length) * Cast(F('document__length'), FloatField())
+    else:
+        norm = Value(K1)
+    term_scores = []
+    for term in terms:
+        df = document_frequencies.get(term, 0)
+        idf = math.log(1 + (total_documents - df + 0.5) / (df + 0.5))
+        term_scores.append(When(term=term, then=Value(idf * (K1 + 1)) * frequency / (frequency + norm)))
+    top = list(
+        postings.values('document_id')
+        .annotate(score=Sum(Case(*term_scores, output_field=FloatField())))
+        .order_by('-score', 'document_id')
+        .values_list('document_id', 'score')[:limit]
+    )
+    documents = SearchDocument.objects.in_bulk([document_id for document_id, _score in top])
+    results = []
+    for document_id, score in top:
+        document = documents[document_id]
+        text = document_text(document)
+        results.append({
+            'type': document.doc_type,
+            'id': document.object_id,
+            'timestamp': document.timestamp,
+            'score': round(score, 4),
+            'snippet': highlight(text, terms) if text is not None else '',
+        })
+    return results
+
+
+def document_text(document):
+    if document.doc_type == 'request':
+        return PatientRequest.objects.filter(pk=document.object_id).values_list('details', flat=True).first()
+    text = Message.objects.filter(pk=document.object_id).values_list('text', flat=True).first()
+    if text is None:
+        archived = find_archived_message(document.patient_id, document.object_id)
+        text = archived['text'] if archived else None
+    return text
+
+
+def highlight(text, terms, width=160):
+    # Escaped snippet around the first matching term, with every match wrapped in <mark>
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(term) for term in terms) + r')', re.IGNORECASE)
+    match = pattern.search(text)
+    start = max(0, match.start() - width // 3) if match else 0
+    snippet = text[start:start + width]
+    parts = []
+    last = 0
+    for found in pattern.finditer(snippet):
+        parts.append(html.escape(snippet[last:found.start()]))
+        parts.append(f'<mark>{html.escape(found.group(0))}</mark>')
+        last = found.end()
+    parts.append(html.escape(snippet[last:]))
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if start + width < len(text) else ''
+    return prefix + ''.join(parts) + suffix
@@ -0,0 +1,27 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .measurements import record_patient_weights
+from .models import Message, Patient, PatientRequest
+from .retrieval import remember_message
+from .search import index_message, index_patient_request
+
+
+@receiver(post_save, sender=Message)
+def index_saved_message(sender, instance, **kwargs):
+    index_message(instance)
+
+
+@receiver(post_save, sender=Message)
+def remember_saved_message(sender, instance, **kwargs):
+    remember_message(instance)
+
+
+@receiver(post_save, sender=PatientRequest)
+def index_saved_patient_request(sender, instance, **kwargs):
+    index_patient_request(instance)
+
+
+@receiver(post_save, sender=Patient)
+def record_saved_patient_weight(sender, instance, **kwargs):
+    record_patient_weights([instance])
@@ -1,3 +1,799 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.urls import reverse
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from . import resilience, retrieval
+from .analytics import SAFETY_LAG, dashboard, update_rollups
+from .archive import archive_patient_messages, find_archived_message, iter_archived_messages, load_history_page
+from .measurements import refresh_summaries, summarize_trends
+from .middleware import GraphSessionMiddleware, connection_stats
+from .neo4j_driver import Neo4jDriver, get_patient_properties
+from .models import (
+    DailyMessageRollup, Measurement, MeasurementSummary, MemoryItem, Message, Patient, PatientRequest,
+    RollupWatermark,
+)
+from .rate_limit import (
+    BACKGROUND, INTERACTIVE, RateLimited, acquire_slot, admission_stats, consume_patient_token,
+    llm_slot, release_slot, try_acquire_slot,
+)
+from .replies import LLM_ERROR_REPLY, OFF_TOPIC_REPLY
+from .retrieval import forget_patient, get_index, remember_facts, remember_many, retrieve
+from .resilience import CircuitBreaker, CircuitOpen, DeadlineExceeded, PoolSaturated, call_with_resilience
+
+ADMISSION = {
+    'PATIENT_BUCKET_CAPACITY': 3,
+    'PATIENT_REFILL_PER_SECOND': 1.0,
+    'MAX_CONCURRENCY': 3,
+    'RESERVED_INTERACTIVE_SLOTS': 1,
+    'MAX_QUEUE': 4,
+    'INTERACTIVE_WAIT_SECONDS': 5.0,
+    'BACKGROUND_WAIT_SECONDS': 0.2,
+    'POLL_INTERVAL_SECONDS': 0.005,
+    'SLOT_TTL_SECONDS': 120,
+}
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Condition not reached in time")
+        time.sleep(0.005)
+
+
+@override_settings(LLM_ADMISSION=ADMISSION)
+class PatientBucketTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_bucket_empties_then_refills(self):
+        self.assertEqual([consume_patient_token(1, now=100.0) for _ in range(4)], [True, True, True, False])
+        # One token per second comes back, never more than the capacity
+        self.assertTrue(consume_patient_token(1, now=101.0))
+        self.assertFalse(consume_patient_token(1, now=101.5))
+        self.assertEqual([consume_patient_token(1, now=200.0) for _ in range(4)], [True, True, True, False])
+
+    def test_buckets_are_per_patient(self):
+        for _ in range(3):
+            consume_patient_token(1, now=100.0)
+        self.assertFalse(consume_patient_token(1, now=100.0))
+        self.assertTrue(consume_patient_token(2, now=100.0))
+
+    def test_contended_bucket_lock_gets_the_busy_reply(self):
+        from .replies import BUSY_REPLY
+        from .views import process_bot_response
+
+        with mock.patch('chat.views.consume_patient_token', side_effect=RateLimited("lock")):
+            reply = process_bot_response("I have pain in my knee", mock.Mock(pk=1))[0]
+        self.assertEqual(reply, BUSY_REPLY)
+
+
+@override_settings(LLM_ADMISSION=ADMISSION)
+class LlmSlotTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_full_queue_rejects_immediately(self):
+        with override_settings(LLM_ADMISSION={**ADMISSION, 'MAX_CONCURRENCY': 1, 'MAX_QUEUE': 0}):
+            lease = acquire_slot(INTERACTIVE)
+            started = time.monotonic()
+            with self.assertRaises(RateLimited):
+                acquire_slot(INTERACTIVE)
+            self.assertLess(time.monotonic() - started, 0.1)
+            release_slot(lease)
+        self.assertEqual(admission_stats(), {'in_flight': 0, 'waiting': 0, 'waiting_interactive': 0})
+
+    def test_background_never_takes_reserved_slots(self):
+        leases = [try_acquire_slot(BACKGROUND), try_acquire_slot(BACKGROUND)]
+        self.assertNotIn(None, leases)
+        self.assertIsNone(try_acquire_slot(BACKGROUND))
+        self.assertIsNotNone(try_acquire_slot(INTERACTIVE))
+
+    def test_background_does_not_jump_a_waiting_interactive_call(self):
+        with override_settings(LLM_ADMISSION={**ADMISSION, 'MAX_CONCURRENCY': 1, 'RESERVED_INTERACTIVE_SLOTS': 0}):
+            lease = acquire_slot(INTERACTIVE)
+            served = []
+            waiter = threading.Thread(target=lambda: served.append(acquire_slot(INTERACTIVE)))
+            waiter.start()
+            wait_until(lambda: admission_stats()['waiting_interactive'] == 1)
+
+            release_slot(lease)
+            self.assertIsNone(try_acquire_slot(BACKGROUND))
+            waiter.join()
+            self.assertEqual(len(served), 1)
+
+    def test_slots_stay_bounded_past_the_lease_ttl(self):
+        # Leases are renewed by being replaced, as under steady load; none may leak
+        with override_settings(LLM_ADMISSION={**ADMISSION, 'MAX_CONCURRENCY': 2, 'SLOT_TTL_SECONDS': 1}):
+            leases = [acquire_slot(INTERACTIVE), acquire_slot(INTERACTIVE)]
+            for _ in range(5):
+                time.sleep(0.3)
+                release_slot(leases.pop(0))
+                leases.append(acquire_slot(INTERACTIVE))
+                self.assertIsNone(try_acquire_slot(INTERACTIVE))
+                self.assertEqual(admission_stats()['in_flight'], 2)
+
+    def test_full_queue_admits_interactive_by_displacing_background(self):
+        with override_settings(LLM_ADMISSION={**ADMISSION, 'MAX_CONCURRENCY': 1, 'MAX_QUEUE': 1,
+                                              'RESERVED_INTERACTIVE_SLOTS': 0, 'BACKGROUND_WAIT_SECONDS': 5.0}):
+            lease = acquire_slot(INTERACTIVE)
+            outcomes = []
+
+            def background():
+                try:
+                    release_slot(acquire_slot(BACKGROUND))
+                    outcomes.append('served')
+                except RateLimited:
+                    outcomes.append('rejected')
+
+            waiter = threading.Thread(target=background)
+            waiter.start()
+            wait_until(lambda: admission_stats()['waiting'] == 1)
+            interactive = threading.Thread(target=lambda: outcomes.append(release_slot(acquire_slot(INTERACTIVE))))
+            interactive.start()
+            waiter.join()
+            self.assertEqual(outcomes, ['rejected'])
+            release_slot(lease)
+            interactive.join()
+
+    def test_burst_respects_limits_and_serves_interactive_first(self):
+        lock = threading.Lock()
+        running = {INTERACTIVE: 0, BACKGROUND: 0}
+        peak = {'total': 0, BACKGROUND: 0}
+        waits = {INTERACTIVE: [], BACKGROUND: []}
+        rejected = {INTERACTIVE: 0, BACKGROUND: 0}
+
+        def call(priority):
+            queued_at = time.perf_counter()
+            try:
+                with llm_slot(priority):
+                    with lock:
+                        waits[priority].append(time.perf_counter() - queued_at)
+                        running[priority] += 1
+                        peak['total'] = max(peak['total'], sum(running.values()))
+                        peak[BACKGROUND] = max(peak[BACKGROUND], running[BACKGROUND])
+                    time.sleep(0.02)
+                    with lock:
+                        running[priority] -= 1
+            except RateLimited:
+                with lock:
+                    rejected[priority] += 1
+
+        with override_settings(LLM_ADMISSION={**ADMISSION, 'MAX_QUEUE': 24, 'BACKGROUND_WAIT_SECONDS': 5.0}):
+            threads = [
+                threading.Thread(target=call, args=(INTERACTIVE if number % 2 else BACKGROUND,))
+                for number in range(24)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertLessEqual(peak['total'], ADMISSION['MAX_CONCURRENCY'])
+        self.assertLessEqual(peak[BACKGROUND], ADMISSION['MAX_CONCURRENCY'] - ADMISSION['RESERVED_INTERACTIVE_SLOTS'])
+        self.assertEqual(rejected, {INTERACTIVE: 0, BACKGROUND: 0})
+        # Interactive calls go ahead of queued background work
+        mean = {priority: sum(values) / len(values) for priority, values in waits.items()}
+        self.assertLess(mean[INTERACTIVE], mean[BACKGROUND])
+        self.assertEqual(admission_stats(), {'in_flight': 0, 'waiting': 0, 'waiting_interactive': 0})
+
+    def test_slot_overhead_is_small(self):
+        started = time.perf_counter()
+        for _ in range(200):
+            with llm_slot(INTERACTIVE):
+                pass
+        self.assertLess((time.perf_counter() - started) / 200, 0.005)
+
+
+class FaultyProvider:
+    # Fault-injecting stand-in for the LLM: each call follows the next scripted behaviour,
+    # ('ok', seconds), ('error', seconds) or ('stall', None), which blocks until released
+    def __init__(self, script, default=('ok', 0.0)):
+        self.script = list(script)
+        self.default = default
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.released = threading.Event()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+            behaviour, seconds = self.script.pop(0) if self.script else self.default
+        if behaviour == 'stall':
+            self.released.wait(10)
+            return 'late'
+        time.sleep(seconds)
+        if behaviour == 'error':
+            raise ConnectionError("injected failure")
+        return 'ok'
+
+
+RESILIENCE = {
+    'DEADLINE_SECONDS': 0.2,
+    'RETRIES': 2,
+    'BACKOFF_BASE_SECONDS': 0.001,
+    'BACKOFF_CAP_SECONDS': 0.002,
+    'HEDGE': False,
+    'HEDGE_MIN_SAMPLES': 5,
+    'BREAKER_FAILURE_THRESHOLD': 1000,
+    'BREAKER_RESET_SECONDS': 30.0,
+}
+
+
+@override_settings(LLM_RESILIENCE=RESILIENCE, LLM_ADMISSION=ADMISSION)
+class ResilienceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.providers = []
+
+    def tearDown(self):
+        for provider in self.providers:
+            provider.released.set()
+
+    def provider(self, script=(), default=('ok', 0.0)):
+        provider = FaultyProvider(script, default)
+        self.providers.append(provider)
+        return provider
+
+    def call(self, name, provider, **kwargs):
+        kwargs.setdefault('breaker', CircuitBreaker(1000, 30.0))
+        return call_with_resilience(name, provider, **kwargs)
+
+    def test_tail_latency_is_bounded_by_the_deadline(self):
+        # One call in ten stalls; every call must still finish close to its deadline
+        provider = self.provider(default=('ok', 0.005))
+        provider.script = [('stall', None) if number % 10 == 0 else ('ok', 0.005) for number in range(60)]
+        latencies = []
+
+        def worker():
+            for _ in range(10):
+                started = time.perf_counter()
+                try:
+                    self.call('test_tail', provider, retries=0)
+                except (DeadlineExceeded, PoolSaturated):
+                    pass
+                latencies.append(time.perf_counter() - started)
+
+        threads = [threading.Thread(target=worker) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latencies.sort()
+        p99 = latencies[int(0.99 * (len(latencies) - 1))]
+        self.assertLess(p99, RESILIENCE['DEADLINE_SECONDS'] + 0.1)
+
+    def test_retries_only_idempotent_calls(self):
+        failing = self.provider(default=('error', 0.0))
+        with self.assertRaises(ConnectionError):
+            self.call('test_retry', failing)
+        self.assertEqual(failing.calls, RESILIENCE['RETRIES'] + 1)
+
+        failing = self.provider(default=('error', 0.0))
+        with self.assertRaises(ConnectionError):
+            self.call('test_no_retry', failing, idempotent=False)
+        self.assertEqual(failing.calls, 1)
+
+    def test_breaker_opens_then_half_opens_then_closes(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10.0, clock=lambda: now[0])
+        failing = self.provider(default=('error', 0.0))
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.call('test_breaker', failing, retries=0, breaker=breaker)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpen):
+            self.call('test_breaker', failing, retries=0, breaker=breaker)
+        self.assertEqual(failing.calls, 2)
+
+        # After the reset timeout one probe goes through; a failure re-opens the circuit
+        now[0] = 10.0
+        with self.assertRaises(ConnectionError):
+            self.call('test_breaker', failing, retries=0, breaker=breaker)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        now[0] = 20.0
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.call('test_breaker', self.provider(), breaker=breaker), 'ok')
+
+    def test_rejected_probe_does_not_leave_the_breaker_half_open(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10.0, clock=lambda: now[0])
+        with self.assertRaises(ConnectionError):
+            self.call('test_probe', self.provider(default=('error', 0.0)), retries=0, breaker=breaker)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        # The probe is turned away locally before reaching the provider
+        now[0] = 10.0
+        with mock.patch.object(resilience, '_attempt', side_effect=RateLimited("LLM wait queue is full")):
+            with self.assertRaises(RateLimited):
+                self.call('test_probe', self.provider(), breaker=breaker)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        now[0] = 1000.0
+        self.assertEqual(self.call('test_probe', self.provider(), breaker=breaker), 'ok')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_hedge_won_and_lost_are_counted(self):
+        name = 'test_hedge'
+        fast = self.provider(default=('ok', 0.01))
+        for _ in range(RESILIENCE['HEDGE_MIN_SAMPLES']):
+            self.call(name, fast)
+
+        # The original stalls, so the hedge wins
+        self.assertEqual(self.call(name, self.provider([('stall', None), ('ok', 0.0)]), hedge=True), 'ok')
+        # The original is only a little slow and still beats a slower hedge
+        self.assertEqual(self.call(name, self.provider([('ok', 0.05), ('ok', 0.15)]), hedge=True), 'ok')
+
+        counts = resilience.metrics.snapshot()[name]
+        self.assertEqual(counts['hedged'], 2)
+        self.assertEqual(counts['hedge_won'], 1)
+        self.assertEqual(counts['hedge_lost'], 1)
+
+    def test_abandoned_calls_keep_their_slot_until_they_return(self):
+        provider = self.provider([('stall', None)])
+        with self.assertRaises(DeadlineExceeded):
+            self.call('test_abandoned', provider, retries=0, admission=INTERACTIVE)
+        self.assertEqual(admission_stats()['in_flight'], 1)
+
+        provider.released.set()
+        wait_until(lambda: admission_stats()['in_flight'] == 0)
+
+    def test_saturated_pool_fails_fast(self):
+        resilience._get_executor()
+        with mock.patch.object(resilience, '_running', resilience._executor_workers):
+            started = time.perf_counter()
+            with self.assertRaises(PoolSaturated):
+                self.call('test_saturated', self.provider(), admission=INTERACTIVE)
+            self.assertLess(time.perf_counter() - started, 0.05)
+        self.assertEqual(admission_stats()['in_flight'], 0)
+
+
+def create_patient(**fields):
+    values = {
+        'first_name': 'Test', 'last_name': 'Patient', 'date_of_birth': '1970-01-01',
+        'phone_number': '555-0100', 'email': 'test@example.com', 'medical_condition': 'Asthma',
+        'medication_regimen': 'Albuterol as needed', 'last_appointment': timezone.now(),
+        'next_appointment': timezone.now(), 'doctor_name': 'Smith',
+    }
+    values.update(fields)
+    return Patient.objects.create(**values)
+
+
+class RetrievalIndexTests(TestCase):
+    def setUp(self):
+        # Index versions live in the cache; indexes cached in-process from earlier tests must go with them
+        cache.clear()
+        retrieval._indexes.clear()
+        self.patient = create_patient()
+        self.rows = [
+            ('message', 1, "Patient: my knee pain is worse", timezone.now(), "my knee pain is worse"),
+            ('message', 2, "Patient: I slept well", timezone.now(), "I slept well"),
+        ]
+        remember_many(self.patient.pk, self.rows)
+
+    def knee_results(self):
+        return [item['source_key'] for item in retrieve(self.patient.pk, 'knee pain', 200)]
+
+    def test_rebuild_does_not_leave_stale_copies(self):
+        self.assertEqual(self.knee_results(), ['1'])
+        forget_patient(self.patient.pk)
+        remember_many(self.patient.pk, self.rows)
+        self.assertEqual(len(get_index(self.patient.pk).items), 2)
+        self.assertEqual(self.knee_results(), ['1'])
+
+    def test_deletions_without_a_new_generation_are_noticed(self):
+        self.assertEqual(self.knee_results(), ['1'])
+        MemoryItem.objects.filter(patient=self.patient).delete()
+        remember_many(self.patient.pk, self.rows)
+        self.assertEqual(len(get_index(self.patient.pk).items), 2)
+        self.assertEqual(self.knee_results(), ['1'])
+
+
+class StubGraph:
+    # Stands in for the Neo4j driver with entities extracted before the index existed
+    def __init__(self):
+        self.entity_reads = 0
+
+    def save_patient_data(self, patient):
+        pass
+
+    def get_patient_entities(self, patient_name):
+        self.entity_reads += 1
+        return {'medication': ['metformin', 'lisinopril'], 'symptom': 'headache'}
+
+
+class GraphEntityBackfillTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        retrieval._indexes.clear()
+        self.patient = create_patient()
+        self.graph = StubGraph()
+
+    def entity_keys(self):
+        return set(
+            MemoryItem.objects.filter(patient=self.patient, source_key__contains=':').values_list('source_key', flat=True)
+        )
+
+    def test_rebuild_indexes_graph_entities(self):
+        with mock.patch('chat.management.commands.rebuild_retrieval_index.get_graph_driver', return_value=self.graph):
+            call_command('rebuild_retrieval_index', '--patient-id', str(self.patient.pk), stdout=StringIO())
+        self.assertEqual(self.entity_keys(), {'medication:metformin', 'medication:lisinopril', 'symptom:headache'})
+
+    def test_first_chat_view_indexes_graph_entities(self):
+        with mock.patch('chat.views.neo4j_driver', self.graph):
+            self.client.get(reverse('chat'))
+            self.client.get(reverse('chat'))
+        self.assertEqual(self.entity_keys(), {'medication:metformin', 'medication:lisinopril', 'symptom:headache'})
+        # Once indexed, later page loads do not read the graph again
+        self.assertEqual(self.graph.entity_reads, 1)
+
+
+class GraphSessionTests(TestCase):
+    def setUp(self):
+        # No server: the stub driver hands out sessions that run each transaction function
+        # against a transaction whose queries return no records
+        result = mock.MagicMock()
+        result.single.return_value = None
+        transaction = mock.Mock(**{'run.return_value': result})
+        session = mock.Mock()
+        session.execute_read.side_effect = session.execute_write.side_effect = lambda work: work(transaction)
+        with mock.patch('neo4j.GraphDatabase.driver') as driver:
+            driver.return_value.session.return_value = session
+            self.graph = Neo4jDriver('bolt://localhost:7687', 'neo4j', 'password')
+        self.patient = create_patient()
+
+    def chat_turn(self):
+        # The graph calls of one chat message: patient upsert, entity write, knowledge read
+        self.graph.save_patient_data(self.patient)
+        self.graph.save_entities_batch([("Test Patient", {'symptom': 'headache'})])
+        self.graph.get_patient_knowledge("Test Patient")
+
+    def test_request_scope_shares_one_session(self):
+        self.chat_turn()
+        self.assertEqual(self.graph.pool_stats()['sessions_opened'], 3)
+        with self.graph.request_scope() as scope:
+            self.chat_turn()
+        self.assertEqual(scope, {'sessions_opened': 1, 'sessions_reused': 2})
+        self.assertEqual(self.graph.pool_stats()['sessions_opened'], 4)
+        self.assertEqual(self.graph.pool_stats()['sessions_active'], 0)
+
+    def test_middleware_counts_only_its_own_sessions(self):
+        def get_response(request):
+            self.chat_turn()
+            # Graph work on another thread at the same time is not this request's
+            other = threading.Thread(target=self.chat_turn)
+            other.start()
+            other.join()
+            return 'response'
+
+        before = connection_stats()
+        with mock.patch('chat.middleware.get_graph_driver', return_value=self.graph):
+            middleware = GraphSessionMiddleware(get_response)
+        self.assertEqual(middleware(object()), 'response')
+        after = connection_stats()
+        self.assertEqual(after['requests'] - before['requests'], 1)
+        self.assertEqual(after['graph_sessions_opened'] - before['graph_sessions_opened'], 1)
+        self.assertEqual(self.graph.pool_stats()['sessions_opened'], 4)
+
+
+class JsonlImportTests(TestCase):
+    def write_input(self, lines):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'input.jsonl')
+        with open(path, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        return directory, path
+
+    def test_malformed_patient_lines_are_rejected_in_place(self):
+        patient = {
+            'first_name': 'Ada', 'last_name': 'Lovelace', 'date_of_birth': '1815-12-10',
+            'phone_number': '555-0101', 'email': 'ada@example.com', 'medical_condition': 'Asthma',
+            'medication_regimen': 'None', 'last_appointment': '2024-01-01T09:00:00',
+            'next_appointment': '2024-06-01T09:00:00', 'doctor_name': 'Smith',
+        }
+        directory, path = self.write_input([
+            json.dumps(patient), '{"first_name": "Broken', '[1, 2]', json.dumps({**patient, 'first_name': 'Grace'}),
+        ])
+        errors_path = os.path.join(directory, 'errors.jsonl')
+        output = StringIO()
+        call_command('import_patients', path, '--skip-graph', '--chunk-size', '2', '--errors', errors_path,
+                     stdout=output)
+
+        self.assertEqual(sorted(Patient.objects.values_list('first_name', flat=True)), ['Ada', 'Grace'])
+        with open(errors_path) as handle:
+            errors = [json.loads(line) for line in handle]
+        self.assertEqual([error['row'] for error in errors], [2, 3])
+        self.assertIn('Invalid JSON', errors[0]['errors'])
+        self.assertIn('rejected 2, 4 rows', output.getvalue())
+        self.assertFalse(os.path.exists(f"{path}.checkpoint"))
+
+    def test_imported_weights_are_recorded(self):
+        rows = [
+            {'first_name': first_name, 'last_name': 'Smith', 'date_of_birth': '1980-01-01', 'phone_number': '555-0102',
+             'email': 'smith@example.com', 'medical_condition': 'Asthma', 'medication_regimen': 'None',
+             'last_appointment': '2024-01-01T09:00:00', 'next_appointment': '2024-06-01T09:00:00',
+             'doctor_name': 'Jones', 'weight': weight}
+            for first_name, weight in (('Ann', 60.0), ('Bob', 82.5))
+        ]
+        _directory, path = self.write_input([json.dumps(row) for row in rows])
+        call_command('import_patients', path, '--skip-graph', stdout=StringIO())
+        # Re-importing records only the weight that changed
+        rows[1]['weight'] = 80.0
+        _directory, path = self.write_input([json.dumps(row) for row in rows])
+        call_command('import_patients', path, '--skip-graph', stdout=StringIO())
+
+        weights = Measurement.objects.filter(kind='weight').order_by('patient__first_name', 'value')
+        self.assertEqual(
+            list(weights.values_list('patient__first_name', 'value')), [('Ann', 60.0), ('Bob', 80.0), ('Bob', 82.5)],
+        )
+        self.assertEqual(MeasurementSummary.objects.get(patient__first_name='Bob', kind='weight').latest_value, 80.0)
+
+    def test_malformed_measurement_lines_are_counted_as_rejected(self):
+        patient = create_patient()
+        measurement = {'patient_id': patient.pk, 'kind': 'weight', 'value': 70.5, 'unit': 'kg',
+                       'timestamp': '2024-01-01T09:00:00'}
+        _directory, path = self.write_input([json.dumps(measurement), '{"patient_id": ', json.dumps(measurement)])
+        output = StringIO()
+        call_command('import_measurements', path, stdout=output)
+
+        self.assertEqual(Measurement.objects.filter(patient=patient).count(), 2)
+        self.assertIn('Ingested 2 measurements (1 rejected)', output.getvalue())
+
+
+class SearchViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.patient = create_patient()
+        self.other = create_patient(first_name='Other')
+        self.strong = Message.objects.create(patient=self.patient, sender='patient', text="dosage dosage question")
+        self.weak = Message.objects.create(
+            patient=self.patient, sender='patient', text="a question about the dosage of my evening tablets",
+        )
+        Message.objects.create(patient=self.other, sender='patient', text="dosage dosage dosage")
+
+    def test_patient_is_required_and_validated(self):
+        for params in ({'q': 'dosage'}, {'q': 'dosage', 'patient': 'abc'}):
+            self.assertEqual(self.client.get(reverse('search'), params).status_code, 400)
+
+    def test_results_are_ranked_within_the_patient(self):
+        response = self.client.get(reverse('search'), {'q': 'dosage', 'patient': self.patient.pk})
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([result['id'] for result in results], [self.strong.pk, self.weak.pk])
+        self.assertGreater(results[0]['score'], results[1]['score'])
+        self.assertIn('<mark>dosage</mark>', results[0]['snippet'])
+
+
+class HistoryPaginationTests(TestCase):
+    def setUp(self):
+        self.patient = create_patient()
+        # Two runs of messages sharing a timestamp, as a bulk import or a fast exchange produces
+        shared = timezone.now().replace(microsecond=0)
+        created = Message.objects.bulk_create([
+            Message(patient=self.patient, sender='patient', text=f"message {number}") for number in range(12)
+        ])
+        self.ids = sorted(message.pk for message in created)
+        Message.objects.filter(id__in=self.ids[:6]).update(timestamp=shared - timedelta(minutes=1))
+        Message.objects.filter(id__in=self.ids[6:]).update(timestamp=shared)
+
+    def page_through(self, limit):
+        seen = []
+        before = before_id = None
+        while True:
+            page = load_history_page(self.patient, before=before, before_id=before_id, limit=limit)
+            seen.extend(message['id'] for message in page)
+            if len(page) < limit:
+                return seen
+            before, before_id = page[-1]['timestamp'], page[-1]['id']
+
+    def test_pages_do_not_skip_messages_sharing_a_timestamp(self):
+        self.assertEqual(self.page_through(limit=4), self.ids[::-1])
+
+    def test_archive_keeps_the_newest_messages_and_pages_across_both_tables(self):
+        archive_patient_messages(self.patient, keep_recent=3, segment_size=4, block_size=2)
+        hot = Message.objects.filter(patient=self.patient).order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(hot), self.ids[-3:])
+        self.assertEqual(self.page_through(limit=4), self.ids[::-1])
+        self.assertEqual([message['id'] for message in iter_archived_messages(self.patient)], self.ids[-4::-1])
+
+    def test_archive_boundary_follows_timestamps_not_ids(self):
+        # An early id with the newest timestamp is among the newest messages and stays hot
+        Message.objects.filter(id=self.ids[0]).update(timestamp=timezone.now() + timedelta(minutes=5))
+        archive_patient_messages(self.patient, keep_recent=3)
+        hot = Message.objects.filter(patient=self.patient).order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(hot), [self.ids[0], self.ids[10], self.ids[11]])
+
+    def test_archived_messages_are_found_when_id_ranges_overlap(self):
+        # A low id with the newest timestamp lands in the last segment and block, next to high ids
+        Message.objects.filter(id=self.ids[1]).update(timestamp=timezone.now() + timedelta(minutes=5))
+        archive_patient_messages(self.patient, keep_recent=0, segment_size=4, block_size=2)
+        self.assertFalse(Message.objects.filter(patient=self.patient).exists())
+        for message_id in self.ids:
+            self.assertEqual(find_archived_message(self.patient.pk, message_id)['id'], message_id)
+
+
+class MeasurementTests(TestCase):
+    def test_saving_a_patient_records_a_changed_weight(self):
+        patient = create_patient(weight=70.0)
+        patient.save()
+        patient.weight = 71.5
+        patient.save()
+        weights = Measurement.objects.filter(patient=patient, kind='weight').order_by('timestamp')
+        self.assertEqual(list(weights.values_list('value', flat=True)), [70.0, 71.5])
+        self.assertEqual(MeasurementSummary.objects.get(patient=patient, kind='weight').latest_value, 71.5)
+        self.assertIn('weight 71.5 kg', summarize_trends(patient))
+
+    def test_prompt_keeps_free_text_fields_without_summaries(self):
+        from .views import generate_prompt
+
+        cache.clear()
+        retrieval._indexes.clear()
+        patient = create_patient(lab_tests="HbA1c 7.2", vital_signs="BP 130/85", weight=70.5)
+        remember_facts(patient.pk, get_patient_properties(patient))
+        system_prompt = generate_prompt("What were my lab tests and vital signs? Is my hba1c ok?", patient)[0]['content']
+        self.assertIn('weight 70.5 kg', system_prompt)
+        self.assertIn('HbA1c 7.2', system_prompt)
+        self.assertIn('BP 130/85', system_prompt)
+        # The weight summary stands in for the free-text weight fact
+        self.assertNotIn('Weight: 70.5', system_prompt)
+
+    def test_stale_summaries_are_recomputed(self):
+        patient = create_patient()
+        Measurement.objects.create(
+            patient=patient, kind='systolic_bp', value=128, unit='mmHg', timestamp=timezone.now() - timedelta(days=25),
+        )
+        # Summarized three weeks ago, when the reading was in its 7-day window, and not refreshed since
+        refresh_summaries([patient.pk], now=timezone.now() - timedelta(days=21))
+        MeasurementSummary.objects.filter(patient=patient).update(updated_at=timezone.now() - timedelta(days=21))
+        self.assertEqual(MeasurementSummary.objects.get(patient=patient).count_7d, 1)
+
+        summarize_trends(patient)
+        summary = MeasurementSummary.objects.get(patient=patient)
+        self.assertEqual((summary.count_7d, summary.count_30d), (0, 1))
+        self.assertGreater(summary.updated_at, timezone.now() - timedelta(minutes=1))
+
+
+class ArchiveRollupTests(TestCase):
+    def test_archiving_stops_at_the_rollup_watermark(self):
+        patient = create_patient()
+        created = Message.objects.bulk_create([
+            Message(patient=patient, sender='patient', text=f"message {number}") for number in range(10)
+        ])
+        ids = sorted(message.pk for message in created)
+        Message.objects.filter(id__in=ids[:6]).update(timestamp=timezone.now() - timedelta(days=2))
+
+        # The last four are too recent to be rolled up yet, so they must stay in the hot table
+        call_command('archive_messages', '--keep', '0', '--patient-id', str(patient.pk), stdout=StringIO())
+        hot = Message.objects.filter(patient=patient).order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(hot), ids[6:])
+        self.assertEqual(RollupWatermark.objects.get(source='messages').last_id, ids[5])
+        counted = sum(DailyMessageRollup.objects.filter(patient=patient).values_list('patient_messages', flat=True))
+        self.assertEqual(counted, 6)
+
+
+class ReextractEntitiesTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.checkpoint = os.path.join(directory, 'reextract.checkpoint')
+        self.failed = f"{self.checkpoint}.failed"
+        self.patient = create_patient()
+        created = Message.objects.bulk_create([
+            Message(patient=self.patient, sender='patient', text=f"message {number}: I have a headache")
+            for number in range(6)
+        ])
+        self.ids = sorted(message.pk for message in created)
+        # The three oldest only exist in the archive
+        archive_patient_messages(self.patient, keep_recent=3)
+
+    def reextract(self, *args):
+        output = StringIO()
+        call_command('reextract_entities', '--offline', '--skip-graph', '--skip-memory', '--batch-size', '2',
+                     '--checkpoint', self.checkpoint, *args, stdout=output)
+        return output.getvalue()
+
+    def read_failed_ids(self):
+        with open(self.failed) as handle:
+            return [json.loads(line)['message_id'] for line in handle]
+
+    def test_resumes_from_the_checkpoint_into_the_archive(self):
+        self.assertIn("Re-extracted 2 messages", self.reextract('--limit', '2'))
+        with open(self.checkpoint) as handle:
+            self.assertEqual(json.load(handle)['last_message_id'], self.ids[4])
+
+        output = self.reextract()
+        self.assertIn(f"Resuming after message {self.ids[4]}", output)
+        # The last hot message, then the three archived ones
+        self.assertIn("Re-extracted 4 messages (4 with entities, 0 failed)", output)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_failed_messages_are_listed_and_retried(self):
+        def extract(text, **kwargs):
+            if text.startswith('message 4'):
+                raise ValueError("bad response")
+            return {'symptom': 'headache'}
+
+        with mock.patch('chat.management.commands.reextract_entities.extract_entities', extract):
+            self.assertIn("6 messages (5 with entities, 1 failed)", self.reextract())
+        self.assertEqual(self.read_failed_ids(), [self.ids[4]])
+
+        self.assertIn("Re-extracted 1 messages (1 with entities, 0 failed)", self.reextract('--retry-failed'))
+        self.assertFalse(os.path.exists(self.failed))
+
+    def test_open_breaker_stops_before_the_checkpoint(self):
+        self.reextract('--limit', '2')
+        with mock.patch('chat.management.commands.reextract_entities.extract_entities',
+                        side_effect=CircuitOpen('gemini_extraction')):
+            with self.assertRaisesMessage(CommandError, "not checkpointed"):
+                self.reextract()
+        with open(self.checkpoint) as handle:
+            self.assertEqual(json.load(handle)['last_message_id'], self.ids[4])
+        self.assertFalse(os.path.exists(self.failed))
+
+
+class AnalyticsRollupTests(TestCase):
+    def setUp(self):
+        self.patient = create_patient()
+        self.other = create_patient(first_name='Other')
+
+    def later(self):
+        # Past the safety lag, so everything written so far is counted
+        return timezone.now() + SAFETY_LAG + timedelta(seconds=1)
+
+    def test_each_run_counts_only_new_rows(self):
+        Message.objects.create(patient=self.patient, sender='patient', text="first")
+        PatientRequest.objects.create(patient=self.patient, request_type='appointment', details="move it")
+        self.assertEqual(update_rollups(now=self.later()), {'messages': 1, 'requests': 1})
+
+        Message.objects.create(patient=self.patient, sender='patient', text="second")
+        PatientRequest.objects.create(patient=self.patient, request_type='appointment', details="again")
+        self.assertEqual(update_rollups(now=self.later()), {'messages': 1, 'requests': 1})
+        self.assertEqual(update_rollups(now=self.later()), {'messages': 0, 'requests': 0})
+
+        stats = dashboard(patient_id=self.patient.pk)
+        self.assertEqual(stats['totals']['patient_messages'], 2)
+        self.assertEqual(stats['requests']['totals'], {'appointment': 2})
+
+    def test_rows_within_the_safety_lag_wait_for_the_next_run(self):
+        Message.objects.create(patient=self.patient, sender='patient', text="just written")
+        self.assertEqual(update_rollups(now=timezone.now()), {'messages': 0, 'requests': 0})
+        self.assertFalse(DailyMessageRollup.objects.exists())
+        self.assertEqual(update_rollups(now=self.later()), {'messages': 1, 'requests': 0})
+
+    def test_dashboard_rates_and_requests_per_patient(self):
+        for sender, text in [
+            ('patient', "my knee hurts"), ('bot', "Rest it."),
+            ('patient', "who won the game?"), ('bot', OFF_TOPIC_REPLY),
+            ('bot', LLM_ERROR_REPLY),
+        ]:
+            Message.objects.create(patient=self.patient, sender=sender, text=text)
+        PatientRequest.objects.create(patient=self.patient, request_type='appointment', details="move it")
+        PatientRequest.objects.create(patient=self.other, request_type='medication', details="change it")
+        update_rollups(now=self.later())
+
+        totals = dashboard(patient_id=self.patient.pk)['totals']
+        self.assertEqual(totals['off_topic_rate'], 0.5)
+        # Two replies came from the LLM and one of them is the error reply
+        self.assertEqual(totals['llm_failure_rate'], 0.5)
+        self.assertEqual(totals['llm_refusal_rate'], 0.0)
+        self.assertEqual(dashboard(patient_id=self.patient.pk)['requests']['totals'], {'appointment': 1})
+        self.assertEqual(dashboard()['requests']['totals'], {'appointment': 1, 'medication': 1})
@@ -3,4 +3,8 @@ from . import views
 
 urlpatterns = [
     path('', views.chat_view, name='chat'),
+    path('history/', views.history_view, name='history'),
+    path('search/', views.search_view, name='search'),
+    path('stats/', views.stats_view, name='stats'),
+    path('analytics/', views.analytics_view, name='analytics'),
 ]
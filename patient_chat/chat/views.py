@@ -1,19 +1,31 @@
 # Imports
 import os
-import re
 from datetime import datetime
 from dotenv import load_dotenv
+from django.http import JsonResponse
 from django.shortcuts import render
+from django.utils.dateparse import parse_date, parse_datetime
 from dateparser.search import search_dates
 
+from .analytics import dashboard
+from .extraction import extract_entities_with_llm, preprocess_message
+from .archive import load_history_page
+from .measurements import format_trends, replaced_raw_fields, trend_summaries
 from .models import Message, Patient, PatientRequest
-from .neo4j_driver import Neo4jDriver
+from .middleware import connection_stats
+from .neo4j_driver import get_graph_driver, get_patient_properties
+from .retrieval import count_tokens, has_memory, remember_entities, remember_facts, retrieve
+from .resilience import call_with_resilience, get_config as resilience_config, metrics as llm_call_metrics
+from .resilience import pool_stats as llm_pool_stats
+from .search import search
+from .replies import BUSY_REPLY, LLM_ERROR_REPLY, LLM_REFUSAL_REPLY, OFF_TOPIC_REPLY
+from .rate_limit import (
+    INTERACTIVE, RateLimited, admission_stats, consume_patient_token,
+)
 
 # LangChain imports
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.schema import HumanMessage, AIMessage, SystemMessage
-from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain.prompts import PromptTemplate
 
 # Load environment variables
 load_dotenv(override=True)
@@ -23,15 +35,30 @@ GEMINI_API_KEY = os.getenv("LLM_API_KEY")
 LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "gemini-1.5-flash")
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable not set.")
+LLM_CALL_TIMEOUT = resilience_config()['CALL_TIMEOUT_SECONDS']
 
-# Initialize the Neo4j driver
-neo4j_driver = Neo4jDriver("bolt://localhost:7687", "neo4j", "dtxplus2024")  # Update with your credentials
+# Latest messages always included in the prompt, before retrieved history
+RECENT_MESSAGES = 4
+
+# Messages rendered with the page; older history is fetched from history_view on scroll
+CHAT_PAGE_SIZE = 50
+
+# Shared Neo4j driver; connection settings come from settings.NEO4J
+neo4j_driver = get_graph_driver()
+
+# View Functions
+def recent_messages(patient):
+    latest = Message.objects.filter(patient=patient).order_by('-timestamp', '-id')[:CHAT_PAGE_SIZE]
+    return list(reversed(latest))
 
-# View Function
 def chat_view(request):
-    messages = Message.objects.all().order_by('timestamp')
     patient = Patient.objects.first()
+    messages = recent_messages(patient)
     neo4j_driver.save_patient_data(patient)
+    if not has_memory(patient.pk):
+        # First index of this patient: entities extracted earlier only live in the graph
+        remember_entities(patient.pk, neo4j_driver.get_patient_entities(f"{patient.first_name} {patient.last_name}"))
+    remember_facts(patient.pk, get_patient_properties(patient))
     request_output = None
     entities = None
     conversation_summary = None
@@ -40,13 +67,13 @@ def chat_view(request):
     if request.method == 'POST':
         user_message = request.POST.get('message')
         if user_message:
-            Message.objects.create(sender='patient', text=user_message)
+            Message.objects.create(patient=patient, sender='patient', text=user_message)
             bot_response, request_output, entities, conversation_summary, medical_insights = process_bot_response(
                 user_message, patient)
-            Message.objects.create(sender='bot', text=bot_response)
+            Message.objects.create(patient=patient, sender='bot', text=bot_response)
 
         context = {
-            'messages': Message.objects.all().order_by('timestamp'),
+            'messages': recent_messages(patient),
             'patient': patient,
             'request_output': request_output,
             'entities': entities,
@@ -65,11 +92,93 @@ def chat_view(request):
     }
     return render(request, 'chat/chat.html', context)
 
+def history_view(request):
+    # Older messages for the scroll-back in the chat page, read from the hot table and then the archive
+    patient = Patient.objects.first()
+    # The cursor is the oldest message shown so far: its timestamp, plus its id to tell apart
+    # messages sharing that timestamp
+    try:
+        before = parse_datetime(request.GET['before']) if request.GET.get('before') else None
+        before_id = int(request.GET['before_id']) if before and request.GET.get('before_id') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor.'}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', CHAT_PAGE_SIZE)), 200)
+    except ValueError:
+        limit = CHAT_PAGE_SIZE
+
+    page = load_history_page(patient, before=before, before_id=before_id, limit=limit)
+    return JsonResponse({
+        'messages': [
+            {
+                'id': m['id'],
+                'sender': m['sender'],
+                'text': m['text'],
+                'timestamp': m['timestamp'].isoformat(),
+            }
+            for m in page
+        ],
+        'has_more': len(page) == limit,
+    })
+
+def search_view(request):
+    # Full-text search over one patient's messages and requests, optionally narrowed to a date range
+    query = request.GET.get('q', '').strip()
+    try:
+        patient_id = int(request.GET['patient'])
+        start = parse_datetime(request.GET['from']) if request.GET.get('from') else None
+        end = parse_datetime(request.GET['to']) if request.GET.get('to') else None
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'A numeric patient id is required; dates must be ISO 8601.'}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', 20)), 100)
+    except ValueError:
+        limit = 20
+
+    results = search(query, patient=patient_id, start=start, end=end, limit=limit) if query else []
+    return JsonResponse({
+        'query': query,
+        'results': [
+            {**result, 'timestamp': result['timestamp'].isoformat()}
+            for result in results
+        ],
+    })
+
+def stats_view(request):
+    # Connection pool, admission control and LLM call counters for this worker process
+    return JsonResponse({
+        'connections': connection_stats(),
+        'graph_pool': neo4j_driver.pool_stats(),
+        'llm_admission': admission_stats(),
+        'llm_calls': llm_call_metrics.snapshot(),
+        'llm_pool': llm_pool_stats(),
+    })
+
+def analytics_view(request):
+    # Usage dashboard data, read from the daily rollups kept current by the update_rollups command
+    try:
+        start = parse_date(request.GET['from']) if request.GET.get('from') else None
+        end = parse_date(request.GET['to']) if request.GET.get('to') else None
+        patient_id = int(request.GET['patient']) if request.GET.get('patient') else None
+    except ValueError:
+        return JsonResponse({'error': 'Invalid date or patient id.'}, status=400)
+
+    return JsonResponse(dashboard(start=start, end=end, patient_id=patient_id))
+
 # Helper Functions
 def process_bot_response(user_message, patient):
     # Check if the message is health-related
     if not is_health_related(user_message):
-        return "I'm sorry, but I can only assist with health-related questions.", None, None, None, None
+        return OFF_TOPIC_REPLY, None, None, None, None
+
+    # Per-patient rate limit: reply straight away instead of queueing more LLM work
+    try:
+        allowed = consume_patient_token(patient.pk)
+    except RateLimited:
+        # The bucket lock stayed contended; treat it like an empty bucket
+        allowed = False
+    if not allowed:
+        return BUSY_REPLY, None, None, None, None
 
     # Preprocess the message
     preprocessed_message = preprocess_message(user_message)
@@ -77,13 +186,17 @@ def process_bot_response(user_message, patient):
     # Generate messages for the AI model
     messages = generate_prompt(preprocessed_message, patient)
 
-    # Get response from the AI model
-    bot_response = get_gemini_response(messages)
+    # Get response from the AI model (each request holds an interactive LLM slot)
+    try:
+        bot_response = get_gemini_response(messages)
+    except RateLimited:
+        bot_response = BUSY_REPLY
 
-    # Extract entities from the user's message
+    # Extract entities from the user's message (background priority, skipped under load)
     entities = extract_entities_with_llm(preprocessed_message)
     if entities:
         neo4j_driver.save_entities(f"{patient.first_name} {patient.last_name}", entities)
+        remember_entities(patient.pk, entities)
 
     # Generate conversation summary and medical insights
     conversation_summary, medical_insights = generate_summary_and_insights(patient)
@@ -185,10 +298,6 @@ def is_treatment_request(message):
     ]
     return any(phrase in message.lower() for phrase in treatment_keywords)
 
-def preprocess_message(message):
-    # Replace ordinal numbers with cardinal numbers (e.g., '1st' -> '1')
-    return re.sub(r'\b(\d+)(st|nd|rd|th)\b', r'\1', message)
-
 def extract_requested_time(message):
     message = message.lower()
     import re
@@ -233,10 +342,10 @@ def extract_requested_time(message):
     else:
         return 'unspecified time'
 
-def format_patient_knowledge(knowledge):
+def format_patient_knowledge(knowledge, exclude=()):
     knowledge_items = []
     for key, value in knowledge.items():
-        if value:
+        if value and key not in exclude:
             if isinstance(value, list):
                 filtered_values = [str(v) for v in value if v is not None]
                 value_str = ', '.join(filtered_values) if filtered_values else ''
@@ -247,35 +356,63 @@ def format_patient_knowledge(knowledge):
     return "; ".join(knowledge_items)
 
 def generate_prompt(user_message, patient):
-    patient_knowledge = neo4j_driver.get_patient_knowledge(f"{patient.first_name} {patient.last_name}")
-    patient_knowledge_text = format_patient_knowledge(patient_knowledge)
-
-    system_message = (
+    system_header = (
         f"You are HealthBot, a friendly and empathetic health assistant chatbot. "
         f"You are assisting {patient.first_name} {patient.last_name}. "
-        f"Patient information: {patient_knowledge_text}. "
+    )
+    system_footer = (
         "Provide clear, supportive responses to their questions. "
         "If the patient requests to change an appointment or treatment, respond with "
         f"'I will convey your request to Dr. {patient.doctor_name}.' "
         "Do not mention any limitations or inability to assist. "
         "Use simple language and a conversational tone."
     )
-
-    messages = [{'role': 'system', 'content': system_message}]
-    total_tokens = len(system_message.split())
     max_tokens = 500
 
-    recent_messages = Message.objects.all().order_by('-timestamp')[:5]
-
-    for msg in reversed(recent_messages):
-        role = 'user' if msg.sender == 'patient' else 'assistant'
-        content = msg.text
-        content_tokens = len(content.split())
-        if total_tokens + content_tokens > max_tokens:
+    # The last few turns always go in for continuity; the rest of the budget goes to
+    # the facts and earlier messages most relevant to the current message
+    recent = list(Message.objects.filter(patient=patient).order_by('-timestamp')[:RECENT_MESSAGES])
+    recent_messages = []
+    total_tokens = count_tokens(system_header) + count_tokens(system_footer) + count_tokens(user_message)
+
+    # Measurement trends replace the free-text lab tests, vital signs and weight fields they cover
+    summaries = trend_summaries(patient)
+    trends_text = format_trends(summaries)
+    trends = f"Recent measurements: {trends_text}. " if trends_text else ""
+    raw_fields = replaced_raw_fields(summaries)
+    total_tokens += count_tokens(trends)
+    for msg in recent:
+        content_tokens = count_tokens(msg.text)
+        if total_tokens + content_tokens > max_tokens // 2:
             break
-        messages.append({'role': role, 'content': content})
+        recent_messages.insert(0, msg)
         total_tokens += content_tokens
 
+    if has_memory(patient.pk):
+        retrieved = retrieve(
+            patient.pk, user_message, max_tokens - total_tokens,
+            exclude_message_ids=[msg.id for msg in recent],
+        )
+        facts = [
+            item['text'] for item in retrieved
+            if item['source'] == 'fact' and item['source_key'] not in raw_fields
+        ]
+        history = sorted(
+            (item for item in retrieved if item['source'] == 'message'), key=lambda item: item['timestamp']
+        )
+        context = f"Patient information: {'; '.join(facts)}. " if facts else ""
+        if history:
+            context += "Relevant earlier conversation: " + " | ".join(item['text'] for item in history) + ". "
+    else:
+        # Nothing indexed for this patient yet: fall back to the full knowledge graph dump
+        patient_knowledge = neo4j_driver.get_patient_knowledge(f"{patient.first_name} {patient.last_name}")
+        context = f"Patient information: {format_patient_knowledge(patient_knowledge, exclude=raw_fields)}. "
+
+    messages = [{'role': 'system', 'content': system_header + context + trends + system_footer}]
+    for msg in recent_messages:
+        role = 'user' if msg.sender == 'patient' else 'assistant'
+        messages.append({'role': role, 'content': msg.text})
+
     messages.append({'role': 'user', 'content': user_message})
     return messages
 
@@ -297,56 +434,22 @@ def get_gemini_response(messages):
             top_p=0.8,
             top_k=40,
             google_api_key=GEMINI_API_KEY,
+            max_retries=0,
+            timeout=LLM_CALL_TIMEOUT,
         )
-        response = chat(lc_messages)
+        # Deadline, retries, circuit breaking and admission are handled by the resilience wrapper
+        response = call_with_resilience('gemini_chat', lambda: chat(lc_messages), admission=INTERACTIVE)
         bot_reply = response.content
 
         if contains_disallowed_content(bot_reply):
-            return "I'm sorry, but I can't assist with that request."
+            return LLM_REFUSAL_REPLY
         return bot_reply.strip()
 
+    except RateLimited:
+        # Overloaded locally: the caller answers with BUSY_REPLY
+        raise
     except Exception:
-        return "Sorry, I'm having trouble responding right now."
-
-def extract_entities_with_llm(message):
-    response_schemas = [
-        ResponseSchema(name="medication", description="Name of the medication mentioned by the patient"),
-        ResponseSchema(name="frequency", description="Frequency of medication intake"),
-        ResponseSchema(name="date", description="Date mentioned in the message"),
-        ResponseSchema(name="time", description="Time mentioned in the message"),
-        ResponseSchema(name="symptom", description="Symptom mentioned by the patient"),
-        ResponseSchema(name="diet", description="Diet mentioned by the patient"),
-        ResponseSchema(name="lab_test", description="Lab test mentioned by the patient"),
-        ResponseSchema(name="vital_sign", description="Vital sign mentioned by the patient"),
-    ]
-
-    output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-    format_instructions = output_parser.get_format_instructions()
-
-    prompt = PromptTemplate(
-        template=(
-            "You are an assistant that extracts relevant health-related information from patient messages. "
-            "Only extract information related to medications, symptoms, dates, times, and present it in the specified JSON format.\n"
-            "{format_instructions}\n\nMessage: {message}\n"
-        ),
-        input_variables=["message"],
-        partial_variables={"format_instructions": format_instructions}
-    )
-
-    _input = prompt.format_prompt(message=message)
-    llm = ChatGoogleGenerativeAI(
-        model=LLM_MODEL_NAME,
-        temperature=0,
-        google_api_key=GEMINI_API_KEY,
-    )
-
-    try:
-        response = llm([HumanMessage(content=_input.to_string())])
-        entities = output_parser.parse(response.content)
-    except Exception:
-        entities = {}
-
-    return entities
+        return LLM_ERROR_REPLY
 
 # def generate_summary_and_insights(patient):
 #     recent_messages = Message.objects.all().order_by('-timestamp')[:10]
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'chat.middleware.GraphSessionMiddleware',
 ]
 
 ROOT_URLCONF = 'patient_chat.urls'
@@ -84,11 +86,73 @@ DATABASES = {
         'PORT': '3306',
         'OPTIONS': {
             'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
-        }
+        },
+        # Keep connections open between requests (seconds, 0 closes after every request)
+        # and check them before reuse so a dropped connection is replaced transparently
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', '300')),
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'true').lower() in ('1', 'true', 'yes'),
+    }
+}
+
+
+# Neo4j knowledge graph (see chat/neo4j_driver.py)
+
+NEO4J = {
+    'uri': os.getenv('NEO4J_URI', 'bolt://localhost:7687'),
+    'user': os.getenv('NEO4J_USER', 'neo4j'),
+    'password': os.getenv('NEO4J_PASSWORD', 'dtxplus2024'),
+    'max_connection_pool_size': int(os.getenv('NEO4J_MAX_POOL_SIZE', '50')),
+    'connection_acquisition_timeout': float(os.getenv('NEO4J_ACQUISITION_TIMEOUT', '10')),
+    'max_connection_lifetime': int(os.getenv('NEO4J_MAX_CONNECTION_LIFETIME', '3600')),
+    'liveness_check_timeout': float(os.getenv('NEO4J_LIVENESS_CHECK_TIMEOUT', '30')),
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# LLM admission control keeps its state here; point this at a shared backend
+# (e.g. Redis or Memcached) when running more than one worker process.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
     }
 }
 
 
+# LLM admission control (see chat/rate_limit.py)
+
+LLM_ADMISSION = {
+    'PATIENT_BUCKET_CAPACITY': int(os.getenv('LLM_PATIENT_BUCKET_CAPACITY', '5')),
+    'PATIENT_REFILL_PER_SECOND': float(os.getenv('LLM_PATIENT_REFILL_PER_SECOND', '0.2')),
+    'MAX_CONCURRENCY': int(os.getenv('LLM_MAX_CONCURRENCY', '8')),
+    'RESERVED_INTERACTIVE_SLOTS': int(os.getenv('LLM_RESERVED_INTERACTIVE_SLOTS', '2')),
+    'MAX_QUEUE': int(os.getenv('LLM_MAX_QUEUE', '16')),
+    'INTERACTIVE_WAIT_SECONDS': float(os.getenv('LLM_INTERACTIVE_WAIT_SECONDS', '10')),
+    'BACKGROUND_WAIT_SECONDS': float(os.getenv('LLM_BACKGROUND_WAIT_SECONDS', '2')),
+}
+
+
+# LLM call resilience (see chat/resilience.py)
+
+LLM_RESILIENCE = {
+    'DEADLINE_SECONDS': float(os.getenv('LLM_DEADLINE_SECONDS', '20')),
+    'RETRIES': int(os.getenv('LLM_RETRIES', '2')),
+    'HEDGE': os.getenv('LLM_HEDGE', 'false').lower() in ('1', 'true', 'yes'),
+    'BREAKER_FAILURE_THRESHOLD': int(os.getenv('LLM_BREAKER_FAILURE_THRESHOLD', '5')),
+    'BREAKER_RESET_SECONDS': float(os.getenv('LLM_BREAKER_RESET_SECONDS', '30')),
+    'MAX_WORKERS': int(os.getenv('LLM_CALL_WORKERS', '16')),
+    'CALL_TIMEOUT_SECONDS': float(os.getenv('LLM_CALL_TIMEOUT_SECONDS', '60')),
+}
+
+
+# Retrieval index (see chat/retrieval.py): patients with more indexed items than this
+# use approximate (LSH) search instead of exact brute force. Unset keeps it exact.
+
+RETRIEVAL_ANN_THRESHOLD = int(os.environ['RETRIEVAL_ANN_THRESHOLD']) if os.getenv('RETRIEVAL_ANN_THRESHOLD') else None
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 